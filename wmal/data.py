@@ -14,15 +14,17 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import cPickle
 import os.path
 
 import messenger
+import storage
 import utils
 
 import sys
 import threading
 import time
+import Queue
+from collections import deque, OrderedDict
 
 class Data(object):
     """
@@ -43,16 +45,23 @@ class Data(object):
     msg = None
     api = None
     showlist = None
-    infocache = dict()
-    queue = list()
+    infocache = None
+    infocache_size = 500
+    queue = deque()
+    queue_index = dict()
+    sending = OrderedDict()
     config = dict()
     meta = {'lastget': 0, 'lastsend': 0, 'version': '', 'altnames': dict() }
 
     autosend_timer = None
+    flush_timer = None
     
     signals = {
                 'show_synced':       None,
                 'queue_changed':     None,
+                'show_added':        None,
+                'show_changed':      None,
+                'show_deleted':      None,
               }
     
     def __init__(self, messenger, config, account, userconfig):
@@ -82,14 +91,38 @@ class Data(object):
         mediatype = self.userconfig.get('mediatype')
         self.msg.info(self.name, "Using %s (%s)" % (libname, mediatype))
         
-        # Get files
+        # Set up the storage engine
         userfolder = "%s.%s" % (account['username'], account['api'])
-        self.queue_file = utils.get_filename(userfolder, '%s.queue' % mediatype)
-        self.info_file = utils.get_filename(userfolder,  '%s.info' % mediatype)
-        self.cache_file = utils.get_filename(userfolder, '%s.list' % mediatype)
-        self.meta_file = utils.get_filename(userfolder, '%s.meta' % mediatype)
+        try:
+            storageclass = storage.engines[self.config['storage_engine']]
+        except KeyError:
+            raise utils.DataFatal("Unknown storage engine: %s" % self.config['storage_engine'])
+        self.storage = storageclass(self.msg, userfolder, mediatype)
+        self.journal = storage.QueueJournal(self.msg, userfolder, mediatype)
         self.lock_file = utils.get_filename(userfolder,  'lock')
         
+        # Every instance needs its own queue
+        self.queue = deque()
+        self.queue_index = dict()
+        self.sending = OrderedDict()
+        self.send_lock = threading.RLock()
+        
+        # Changes waiting to be written by the next flush
+        self.flush_lock = threading.RLock()
+        self.dirty_cache = False
+        self.dirty_shows = dict()
+        self.dirty_info = dict()
+        self.dirty_meta = False
+        
+        # Changes being written right now; only one flush writes at a
+        # time, and it must be taken before flush_lock
+        self.write_lock = threading.Lock()
+        self.writing_info = dict()
+        
+        # Details are only read from disk when needed, keeping
+        # the most recently used ones in memory
+        self.infocache = utils.LRUCache(self.infocache_size)
+        
         # Connect signals
         self.api.connect_signal('show_info_changed', self.info_update)
     
@@ -109,6 +142,8 @@ class Data(object):
     def set_message_handler(self, message_handler):
         self.msg = message_handler
         self.api.set_message_handler(self.msg)
+        self.storage.set_message_handler(self.msg)
+        self.journal.set_message_handler(self.msg)
         
     def start(self):
         """
@@ -121,6 +156,7 @@ class Data(object):
         # Lock the database
         self.msg.debug(self.name, "Locking database...")
         self._lock()
+        self.storage.open()
  
         # Load different caches
         if self._meta_exists():
@@ -128,9 +164,6 @@ class Data(object):
         
         if self._queue_exists():
             self._load_queue()
-
-        if self._info_exists():
-            self._load_info()
         
         # If there is a list cache, load from it
         # otherwise query the API for a remote list
@@ -186,9 +219,62 @@ class Data(object):
                 self.process_queue()
         
             self._save_meta()
-            
+        
+        # Write whatever is still pending
+        self.flush()
+        
+        self.api.close()
+        self.journal.close()
+        self.storage.close()
         self._unlock()
     
+    def flush(self):
+        """
+        Writes pending changes to disk
+        
+        Changes to the list cache, info DB and metadata are batched
+        and written once after the flush delay set in the configuration.
+        Call this to write them immediately instead.
+        
+        """
+        with self.write_lock:
+            # Take the pending changes; anything changed while
+            # they're being written goes to the next flush
+            with self.flush_lock:
+                if self.flush_timer:
+                    self.flush_timer.cancel()
+                    self.flush_timer = None
+                
+                showlist = dict(self.showlist) if self.dirty_cache else None
+                dirty_shows = self.dirty_shows
+                meta = dict(self.meta) if self.dirty_meta else None
+                self.writing_info = self.dirty_info
+                
+                self.dirty_cache = False
+                self.dirty_shows = dict()
+                self.dirty_info = dict()
+                self.dirty_meta = False
+            
+            if showlist is not None:
+                self.msg.debug(self.name, "Saving cache...")
+                self.storage.save_cache(showlist)
+            elif dirty_shows:
+                self.msg.debug(self.name, "Saving %d changed shows..." % len(dirty_shows))
+                changed = [ show for show in dirty_shows.itervalues() if show is not None ]
+                deleted = [ showid for showid, show in dirty_shows.iteritems() if show is None ]
+                self.storage.update_cache(changed, deleted)
+            
+            if self.writing_info:
+                self.msg.debug(self.name, "Saving info DB...")
+                self.storage.update_info(self.writing_info.values())
+            
+            if meta is not None:
+                self.msg.debug(self.name, "Saving metadata...")
+                self.storage.save_meta(meta)
+            
+            with self.flush_lock:
+                self.writing_info = dict()
+    
     def get(self):
         """Get list from memory"""
         return self.showlist
@@ -218,22 +304,20 @@ class Data(object):
         self.showlist[showid] = show
         
         # Check if the show add is already in queue
-        exists = False
-        for q in self.queue:
-            if q['id'] == showid and q['action'] == 'add':
-                # This shouldn't happen
-                raise utils.DataError("Show already in the queue.")
-        
-        if not exists:
-            # Use the whole show as a queue item
-            item = show
-            item['action'] = 'add'
-            self.queue.append(item)
+        if (showid, 'add') in self.queue_index:
+            # This shouldn't happen
+            raise utils.DataError("Show already in the queue.")
+        
+        # Use the whole show as a queue item
+        item = show
+        item['action'] = 'add'
+        self._queue_append(item)
+        self._journal_queue('add', item)
         
         show['queued'] = True
         
-        self._save_queue()
-        self._save_cache()
+        self._save_show(show)
+        self._forget_validators()
         self._emit_signal('queue_changed', len(self.queue))
         self.msg.info(self.name, "Queued add for %s" % show['title'])
         
@@ -255,24 +339,21 @@ class Data(object):
         show[key] = value
         
         # Check if the show update is already in queue
-        exists = False
-        for q in self.queue:
-            if q['id'] == show['id'] and q['action'] in ['add', 'update']:
-                # Add the changed value to the already existing queue item
-                q[key] = value
-                exists = True
-                break
-            
-        if not exists:
+        q = self.queue_index.get((show['id'], 'add')) or self.queue_index.get((show['id'], 'update'))
+        if q:
+            # Add the changed value to the already existing queue item
+            q[key] = value
+        else:
             # Create queue item and append it
             item = {'id': show['id'], 'action': 'update', 'title': show['title']}
             item[key] = value
-            self.queue.append(item)
+            self._queue_append(item)
         
+        self._journal_queue('update', show['id'], show['title'], {key: value})
         show['queued'] = True
         
-        self._save_queue()
-        self._save_cache()
+        self._save_show(show)
+        self._forget_validators()
         self._emit_signal('queue_changed', len(self.queue))
         self.msg.info(self.name, "Queued update for %s" % show['title'])
         
@@ -300,29 +381,32 @@ class Data(object):
         
         item = self.showlist.pop(showid)
         
-        # Check if the show add is already in queue
-        exists = False
-        for q in self.queue:
-            if q['id'] == showid and q['action'] == 'delete':
-                # This shouldn't happen
-                raise utils.DataError("Show delete already in the queue.")
+        # Check if the show delete is already in queue
+        if (showid, 'delete') in self.queue_index:
+            # This shouldn't happen
+            raise utils.DataError("Show delete already in the queue.")
         
-        if not exists:
-            # Use the whole show as a queue item
-            item['action'] = 'delete'
-            self.queue.append(item)
+        # Use a copy of the whole show as a queue item; the show itself
+        # may already be in the queue as a pending add
+        item = dict(item)
+        item['action'] = 'delete'
+        self._queue_append(item)
+        self._journal_queue('delete', item)
         
         show['queued'] = True
         
-        self._save_queue()
-        self._save_cache()
+        self._delete_show(showid)
+        self._forget_validators()
         self._emit_signal('queue_changed', len(self.queue))
         self.msg.info(self.name, "Queued delete for %s" % item['title'])
     
     def queue_clear(self):
         """Clears the queue completely."""
-        self.queue = []
-        self._save_queue()
+        self.queue = deque()
+        self.queue_index = dict()
+        self.sending = OrderedDict()
+        self._journal_queue('clear')
+        self._forget_validators()
         self._emit_signal('queue_changed', len(self.queue))
         self.msg.info(self.name, "Cleared queue.")
         
@@ -335,6 +419,12 @@ class Data(object):
         and failed updates stay there to be processed the next time.
 
         """
+        # Only one sync can run at a time; a second one waits and then
+        # sends whatever is left
+        with self.send_lock:
+            self._process_queue()
+    
+    def _process_queue(self):
         if len(self.queue):
             self.msg.info(self.name, 'Processing queue...')
             
@@ -342,75 +432,178 @@ class Data(object):
             if not self.showlist:
                 self._load_cache()
             
-            # Check log-in TODO
-            #try:
-            #    self.api.check_credentials()
-            #except utils.APIError, e:
-            #    raise utils.DataError("Can't process queue, will leave unsynced. Reason: %s" % e.message)
+            # Group the items by show; the items of a single show are
+            # sent one after the other, but different shows can be sent
+            # concurrently if the API allows it
+            groups = OrderedDict()
+            for show in self.queue:
+                groups.setdefault(show['id'], []).append(show)
+            workers = min(self.api.max_concurrency, len(groups))
             
-            # Run through queue
-            for i in xrange(len(self.queue)):
-                show = self.queue.pop(0)
-                showid = show['id']
-                
+            if workers > 1:
+                # Log in once before the workers start
                 try:
-                    # Call the API to do the requested operation
-                    operation = show.get('action')
-                    if operation == 'add':
-                        self.api.add_show(show)
-                    elif operation == 'update':
-                        self.api.update_show(show)
-                    elif operation == 'delete':
-                        self.api.delete_show(show)
-                    else:
-                        self.msg.warn(self.name, "Unknown operation in queue, skipping...")
-                    
-                    if self.showlist.get(showid):
-                        self.showlist[showid]['queued'] = False
-                        self._emit_signal('show_synced', self.showlist[showid])
-                    
-                    self._emit_signal('queue_changed', len(self.queue))
+                    self.api.check_credentials()
                 except utils.APIError, e:
-                    self.msg.warn(self.name, "Can't process %s, will leave unsynced." % show['title'])
-                    self.msg.debug(self.name, "Info: %s" % e.message)
-                    self.queue.append(show)
-                except NotImplementedError:
-                    self.msg.warn(self.name, "Operation not implemented in API. Skipping...")
-                    self.queue.append(show)
-                #except TypeError:
-                #    self.msg.warn(self.name, "%s not in list, unexpected. Not changing queued status." % showid)
+                    self.msg.warn(self.name, "Can't process queue, will leave unsynced. Reason: %s" % e.message)
+                    return
+            
+            # The items being sent leave the queue, so any change made
+            # meanwhile goes to a new item instead of one already sent;
+            # they stay in the journal snapshots until their result is known
+            self.sending = OrderedDict( ((show['id'], show['action']), show) for show in self.queue )
+            self.queue = deque()
+            for key in self.sending:
+                self.queue_index.pop(key, None)
+            self._journal_queue('send', self.sending.keys())
+            pending = len(self.sending)
+            
+            if workers > 1:
+                self.msg.debug(self.name, "Sending with %d workers..." % workers)
+                tasks = Queue.Queue()
+                results = Queue.Queue()
+                for group in groups.itervalues():
+                    tasks.put(group)
+                
+                for i in xrange(workers):
+                    worker = threading.Thread(target=self._queue_worker, args=(tasks, results))
+                    worker.daemon = True
+                    worker.start()
+                
+                # Integrate the results in this thread as they arrive
+                while pending:
+                    (show, result) = results.get()
+                    pending -= 1
+                    self._queue_result(show, result, pending)
+            else:
+                for group in groups.itervalues():
+                    for show, result in self._send_group(group):
+                        pending -= 1
+                        self._queue_result(show, result, pending)
             
+            self.sending = OrderedDict()
             self.api.logout()
-            self._save_cache()
-            self._save_queue()
             
         else:
             self.msg.debug(self.name, 'No items in queue.')
 
         self.meta['lastsend'] = time.time()
+        self._save_meta()
+    
+    def _queue_worker(self, tasks, results):
+        while True:
+            try:
+                group = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            
+            for show, result in self._send_group(group):
+                results.put((show, result))
+    
+    def _send_group(self, group):
+        """Sends the queued items of a show in order, yielding the result of each one"""
+        failed = False
+        for show in group:
+            if failed:
+                # Don't send later changes if an earlier one failed,
+                # otherwise they could end up applied out of order
+                yield (show, ('skipped', None))
+                continue
+            
+            try:
+                # Call the API to do the requested operation
+                operation = show.get('action')
+                if operation == 'add':
+                    self.api.add_show(show)
+                elif operation == 'update':
+                    self.api.update_show(show)
+                elif operation == 'delete':
+                    self.api.delete_show(show)
+                else:
+                    yield (show, ('unknown', None))
+                    continue
+                
+                yield (show, ('ok', None))
+            except utils.APIError, e:
+                failed = True
+                yield (show, ('error', e.message))
+            except NotImplementedError:
+                failed = True
+                yield (show, ('notimplemented', None))
+            except Exception, e:
+                # Anything unexpected must still produce a result,
+                # or the queue processing would wait for it forever
+                failed = True
+                yield (show, ('error', repr(e)))
+    
+    def _queue_result(self, show, result, pending):
+        """Applies the **result** of sending a queued item"""
+        showid = show['id']
+        operation = show.get('action')
+        (status, message) = result
+        # If it's not there anymore the queue was cleared meanwhile
+        cleared = self.sending.pop((showid, operation), None) is None
+        
+        if status in ('ok', 'unknown'):
+            if status == 'unknown':
+                self.msg.warn(self.name, "Unknown operation in queue, skipping...")
+            
+            if not cleared:
+                self._journal_queue('remove', showid, operation)
+            
+            # The show might have been changed again while it was sent
+            queued = any( (showid, action) in self.queue_index for action in ('add', 'update', 'delete') )
+            if self.showlist.get(showid) and not queued:
+                self.showlist[showid]['queued'] = False
+                self._save_show(self.showlist[showid])
+                self._emit_signal('show_synced', self.showlist[showid])
+        else:
+            if status == 'error':
+                self.msg.warn(self.name, "Can't process %s, will leave unsynced." % show['title'])
+                self.msg.debug(self.name, "Info: %s" % message)
+            elif status == 'notimplemented':
+                self.msg.warn(self.name, "Operation not implemented in API. Skipping...")
+            
+            if not cleared:
+                # Take over the update of the show queued while this
+                # one was sent, like queue_update would have done
+                newer = None
+                if operation in ('add', 'update'):
+                    newer = self.queue_index.get((showid, 'update'))
+                if newer:
+                    self.queue.remove(newer)
+                    storage.QueueJournal.merge(show, newer)
+                
+                self._queue_append(show)
+                self._journal_queue('requeue', showid, operation)
+        
+        self._emit_signal('queue_changed', len(self.queue) + pending)
     
     def info_get(self, show):
         try:
-            showid = show['id']
-            return self.infocache[showid]
+            return self._get_infos([show['id']])[show['id']]
         except KeyError:
             return self.api.request_info([show])[0]
 
     def info_update(self, shows):
-        for show in shows:
-            showid = show['id']
-            self.infocache[showid] = show
+        with self.flush_lock:
+            for show in shows:
+                showid = show['id']
+                self.infocache[showid] = show
+                self.dirty_info[showid] = show
         
-        self._save_info()
+        self._schedule_flush()
     
     def altname_get(self, showid):
         return self.meta['altnames'].get(showid, '')
 
     def altname_set(self, showid, altname):
         self.meta['altnames'][showid] = altname
+        self._save_meta()
 
     def altname_clear(self, showid):
         del self.meta['altnames'][showid]
+        self._save_meta()
 
     def altnames_get(self):
         return self.meta['altnames']
@@ -434,46 +627,132 @@ class Data(object):
 
     def _load_cache(self):
         self.msg.debug(self.name, "Reading cache...")
-        self.showlist = cPickle.load( open( self.cache_file , "rb" ) )
+        self.showlist = self.storage.load_cache()
     
     def _save_cache(self):
-        self.msg.debug(self.name, "Saving cache...")
-        cPickle.dump(self.showlist, open( self.cache_file , "wb" ) )
+        with self.flush_lock:
+            self.dirty_cache = True
+        self._schedule_flush()
     
-    def _load_info(self):
-        self.msg.debug(self.name, "Reading info DB...")
-        self.infocache = cPickle.load( open( self.info_file , "rb" ) )
+    def _save_show(self, show):
+        with self.flush_lock:
+            self.dirty_shows[show['id']] = show
+        self._schedule_flush()
+
+    def _delete_show(self, showid):
+        with self.flush_lock:
+            self.dirty_shows[showid] = None
+        self._schedule_flush()
+    
+    def _schedule_flush(self):
+        # Write right away if there's no delay set, otherwise
+        # make sure a flush is coming to take these changes too.
+        # This must not be called with flush_lock held, since
+        # flush() takes write_lock first.
+        if self.config['flush_delay'] <= 0:
+            self.flush()
+            return
+        
+        with self.flush_lock:
+            if not self.flush_timer:
+                self.flush_timer = threading.Timer(self.config['flush_delay'], self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
     
-    def _save_info(self):
-        self.msg.debug(self.name, "Saving info DB...")
-        cPickle.dump(self.infocache, open( self.info_file , "wb" ) )
+    def _get_infos(self, showids):
+        """Returns a dictionary with the locally available details of **showids**"""
+        infos = dict()
+        missing = []
+        with self.flush_lock:
+            for showid in showids:
+                # Look for it in memory first; it could also be a change
+                # that's already out of the cache but not written yet
+                info = self.infocache.get(showid) or self.dirty_info.get(showid) or self.writing_info.get(showid)
+                if info:
+                    infos[showid] = info
+                else:
+                    missing.append(showid)
+        
+        if missing:
+            self.msg.debug(self.name, "Reading %d entries from info DB..." % len(missing))
+            for showid, info in self.storage.get_info(missing).iteritems():
+                self.infocache[showid] = info
+                infos[showid] = info
+        
+        return infos
 
     def _load_queue(self):
         self.msg.debug(self.name, "Reading queue...")
-        self.queue = cPickle.load( open( self.queue_file , "rb" ) )
+        self.queue = deque()
+        self.queue_index = dict()
+        for item in self.journal.load():
+            self._queue_append(item)
+    
+    def _queue_append(self, item):
+        # The index lets us find the queued item of a show
+        # and action without going through the whole queue
+        self.queue.append(item)
+        self.queue_index[(item['id'], item['action'])] = item
     
-    def _save_queue(self):
-        self.msg.debug(self.name, "Saving queue...")
-        cPickle.dump(self.queue, open( self.queue_file , "wb" ) )
+    def _journal_queue(self, *op):
+        self.journal.append(op)
+        
+        if self.journal.needs_compaction():
+            self.journal.compact(self.queue, self.sending.values())
+
+    def _forget_validators(self):
+        # The local list was changed or its changes were discarded, so it
+        # may not match the remote one anymore even if that didn't change;
+        # the next download must get the whole list
+        if self.meta.pop('validators', None):
+            self._save_meta()
 
     def _load_meta(self):
         self.msg.debug(self.name, "Reading metadata...")
-        loadedmeta = cPickle.load( open( self.meta_file , "rb" ) )
+        loadedmeta = self.storage.load_meta()
         self.meta.update(loadedmeta)
     
     def _save_meta(self):
-        self.msg.debug(self.name, "Saving metadata...")
-        cPickle.dump(self.meta, open( self.meta_file , "wb" ) )
+        with self.flush_lock:
+            self.dirty_meta = True
+        self._schedule_flush()
         
     def download_data(self):
-        """Downloads the remote list and overwrites the cache"""
-        self.showlist = self.api.fetch_list()
+        """
+        Downloads the remote list and updates the cache
+        
+        If there's a list cache already, only the shows that were added,
+        changed or removed remotely are applied to it, emitting a signal
+        for each one of them. Otherwise the whole cache is replaced.
+        If the API tells the list didn't change, the cache is used as is.
+        
+        """
+        # Let the API skip downloading the list if it didn't
+        # change since our cache was written
+        if self.meta.get('version') == self.version and self._cache_exists():
+            self.api.validators = dict(self.meta.get('validators', {}))
+        else:
+            self.api.validators = dict()
+        
+        showlist = self.api.fetch_list()
+        
+        if showlist is None:
+            self.msg.info(self.name, "Remote list unchanged, using cache.")
+            if not self.showlist:
+                self._load_cache()
+            
+            self.api.logout()
+            
+            self.meta['lastget'] = time.time()
+            self._save_meta()
+            return
         
         if self.api.api_info['merge']:
             # The API needs information to be merged from the
             # info database
             missing = []
-            for k, show in self.showlist.iteritems():
+            infos = self._get_infos(showlist.iterkeys())
+            for k, show in showlist.iteritems():
                 # Here we search the information in the local
                 # info database. If it isn't available, add it
                 # to the missing list for them to be requested
@@ -481,7 +760,7 @@ class Data(object):
                 showid = show['id']
                 
                 try:
-                    info = self.infocache[showid]
+                    info = infos[showid]
                 except KeyError:
                     missing.append(show)
                     continue
@@ -496,30 +775,66 @@ class Data(object):
                 infos = self.api.request_info(missing)
                 for info in infos:
                     showid = info['id']
-                    self.api.merge(self.showlist[showid], info)
+                    self.api.merge(showlist[showid], info)
 
                     #self.showlist[showid]['title'] = info['title']
                     #self.showlist[showid]['image'] = info['image']
         
-        self._save_cache()
+        # We can only merge into a cache written by this same version
+        if not self.showlist and self._cache_exists() and self.meta.get('version') == self.version:
+            self._load_cache()
+        
+        if self.showlist and self.meta.get('version') == self.version:
+            self._merge_list(showlist)
+        else:
+            self.showlist = showlist
+            self._save_cache()
+        
         self.api.logout()
         
         # Update last retrieved time
         self.meta['lastget'] = time.time()
         self.meta['version'] = self.version
+        self.meta['validators'] = self.api.validators
         self._save_meta()
         
+    def _merge_list(self, showlist):
+        """Applies the differences between **showlist** and the current list"""
+        # These keys are only meaningful locally and never come from the API
+        local_keys = ('queued', 'neweps')
+        (added, changed, deleted) = (0, 0, 0)
+        
+        for showid, show in showlist.iteritems():
+            current = self.showlist.get(showid)
+            if current is None:
+                self.showlist[showid] = show
+                self._save_show(show)
+                self._emit_signal('show_added', show)
+                added += 1
+            elif any( current.get(k) != v for k, v in show.iteritems() if k not in local_keys ):
+                # Update the existing dictionary so any reference
+                # to the show is kept up to date as well
+                current.update( (k, v) for k, v in show.iteritems() if k not in local_keys )
+                self._save_show(current)
+                self._emit_signal('show_changed', current)
+                changed += 1
+        
+        for showid in [ showid for showid in self.showlist if showid not in showlist ]:
+            show = self.showlist.pop(showid)
+            self._delete_show(showid)
+            self._emit_signal('show_deleted', show)
+            deleted += 1
+        
+        self.msg.info(self.name, "List updated: %d added, %d changed, %d removed." % (added, changed, deleted))
+        
     def _cache_exists(self):
-        return os.path.isfile(self.cache_file)
+        return self.storage.cache_exists()
     
-    def _info_exists(self):
-        return os.path.isfile(self.info_file)
-
     def _queue_exists(self):
-        return os.path.isfile(self.queue_file)
+        return self.journal.exists()
 
     def _meta_exists(self):
-        return os.path.isfile(self.meta_file)
+        return self.storage.meta_exists()
     
     def _lock(self):
         """Creates the database lock, returns an exception if it
@@ -20,7 +20,6 @@ import subprocess
 import atexit
 
 import threading
-import difflib
 import time
 import datetime
 import webbrowser
@@ -28,6 +27,7 @@ import shlex
 
 import messenger
 import data
+import library
 import tracker
 import utils
 
@@ -50,6 +50,8 @@ class Engine:
     """
     data_handler = None
     tracker = None
+    library = None
+    watcher = None
     config = dict()
     msg = None
     loaded = False
@@ -59,6 +61,7 @@ class Engine:
     
     signals = { 'show_added':       None,
                 'show_deleted':     None,
+                'show_changed':     None,
                 'episode_changed':  None,
                 'score_changed':    None,
                 'status_changed':   None,
@@ -101,6 +104,9 @@ class Engine:
         self.data_handler = data.Data(self.msg, self.config, self.account, self.userconfig)
         self.data_handler.connect_signal('show_synced', self._data_show_synced)
         self.data_handler.connect_signal('queue_changed', self._data_queue_changed)
+        self.data_handler.connect_signal('show_added', self._data_show_added)
+        self.data_handler.connect_signal('show_changed', self._data_show_changed)
+        self.data_handler.connect_signal('show_deleted', self._data_show_deleted)
         
         # Record the API details
         (self.api_info, self.mediainfo) = self.data_handler.get_api_info()
@@ -110,6 +116,21 @@ class Engine:
     
     def _data_queue_changed(self, queue):
         self._emit_signal('queue_changed', queue)
+    
+    # The following are changes coming from a remote list retrieval.
+    # There's nothing to tell while we're starting up, since the
+    # interface will load the whole list afterwards anyway.
+    def _data_show_added(self, show):
+        if self.loaded:
+            self._emit_signal('show_added', show)
+    
+    def _data_show_changed(self, show):
+        if self.loaded:
+            self._emit_signal('show_changed', show)
+    
+    def _data_show_deleted(self, show):
+        if self.loaded:
+            self._emit_signal('show_deleted', show)
         
     def _tracker_playing(self, showid, playing, episode):
         show = self.get_show_info(showid)
@@ -125,22 +146,31 @@ class Engine:
         except KeyError:
             raise Exception("Call to undefined signal.")
 
+    def _get_tracker_item(self, show):
+        return {'id': show['id'],
+                'title': show['title'], 
+                'my_progress': show['my_progress'],
+                'type': None,
+                'titles': self.get_show_titles(show),
+                } # TODO types
+    
     def _get_tracker_list(self):
         tracker_list = []
         for show in self.get_list():
-                        
-            tracker_list.append({'id': show['id'],
-                                 'title': show['title'], 
-                                 'my_progress': show['my_progress'],
-                                 'type': None,
-                                 'titles': self.get_show_titles(show),
-                                 }) # TODO types
+            tracker_list.append(self._get_tracker_item(show))
         
         return tracker_list
     
-    def _update_tracker(self):
+    def _update_tracker(self, show=None):
+        """
+        Updates the tracker with the new information of **show**,
+        or of the whole list if it's not given.
+        """
         if self.tracker:
-            self.tracker.update_list(self._get_tracker_list())
+            if show:
+                self.tracker.upsert(self._get_tracker_item(show))
+            else:
+                self.tracker.update_list(self._get_tracker_list())
         
     def _cleanup(self):
         # If the engine wasn't closed for whatever reason, do it
@@ -159,6 +189,10 @@ class Engine:
         """Changes the message handler function on the fly."""
         self.msg = messenger.Messenger(message_handler)
         self.data_handler.set_message_handler(self.msg)
+        if self.library:
+            self.library.set_message_handler(self.msg)
+        if self.watcher:
+            self.watcher.set_message_handler(self.msg)
 
     def start(self):
         """
@@ -184,9 +218,15 @@ class Engine:
                                    self.config['tracker_process'],
                                    int(self.config['tracker_interval']),
                                    int(self.config['tracker_update_wait']),
+                                   os.path.expanduser(self.config['tracker_ipc_socket']),
+                                   int(self.config['tracker_update_percent']),
                                   )
             self.tracker.connect_signal('playing', self._tracker_playing)
             self.tracker.connect_signal('update', self._tracker_update)
+        
+        # Start library watcher
+        if self.mediainfo.get('can_play') and self.config['library_watch'] and utils.dir_exists(os.path.expanduser(self.config['searchdir'])):
+            self._start_watcher()
                         
         self.loaded = True
         return True
@@ -202,6 +242,12 @@ class Engine:
         self.msg.info(self.name, "Unloading...")
         self.data_handler.unload()
         
+        if self.watcher:
+            self.watcher.stop()
+            self.watcher = None
+        if self.library:
+            self.library.save()
+        
         # Save config file
         utils.save_config(self.userconfig, self.userconfigfile)
         
@@ -321,7 +367,7 @@ class Engine:
         self.data_handler.queue_add(show)
         
         # Update the tracker with the new information
-        self._update_tracker()
+        self._update_tracker(show)
         
         # Emit signal
         self._emit_signal('show_added', show)
@@ -397,7 +443,7 @@ class Engine:
             self.data_handler.set_show_attr(show, 'neweps', False)
 
         # Update the tracker with the new information
-        self._update_tracker()
+        self._update_tracker(show)
                  
         return show
     
@@ -519,52 +565,65 @@ class Engine:
         self.data_handler.queue_delete(show)
         
         # Update the tracker with the new information
-        self._update_tracker()
+        if self.tracker:
+            self.tracker.remove(show['id'])
         
         # Emit signal
         self._emit_signal('show_deleted', show)
         
-    def _search_video(self, titles, episode):
-        best_candidate = (None, 0)
-
-        matcher = difflib.SequenceMatcher()
-
-        # Check over video files and propose our best candidate
-        for (fullpath, filename) in utils.regex_find_videos('mkv|mp4|avi', self.config['searchdir']):
-            # Analyze what's the title and episode of the file
-            aie = tracker.AnimeInfoExtractor(filename)
-            (candidate_title, candidate_episode) = (aie.getName(), aie.getEpisode())
-
-            # Skip this file if we couldn't analyze it or it isn't the episode we want
-            if not candidate_title or candidate_episode != episode:
+    def _get_library(self):
+        """Returns the index of the media directory, brought up to date."""
+        searchdir = os.path.expanduser(self.config['searchdir'])
+        if not self.library or self.library.searchdir != searchdir:
+            self.library = library.MediaLibrary(self.msg, searchdir,
+                                                cachefile=utils.get_root_filename('library.cache'))
+        
+        self.library.refresh()
+        return self.library
+    
+    def _start_watcher(self):
+        self.msg.info(self.name, "Updating library...")
+        media = self._get_library()
+        try:
+            self.watcher = library.LibraryWatcher(self.msg, media)
+        except OSError, e:
+            self.msg.warn(self.name, "Can't watch the media directory: %s" % e)
+            return
+        
+        # Only hear about files that show up from now on
+        media.connect_signal('episode_added', self._library_episode_added)
+        self.watcher.start()
+    
+    def _library_episode_added(self, title, episode, fullpath):
+        """Flags the shows whose next episode just showed up in the media directory."""
+        status_start = self.mediainfo.get('status_start')
+        for show in self.get_list():
+            if show.get('neweps') or show['my_progress'] + 1 != episode:
+                continue
+            if status_start is not None and show['my_status'] != status_start:
                 continue
             
-            matcher.set_seq1(candidate_title.lower())
-
-            # We remember to compare all titles (aliases and whatnot)
-            for requested_title in titles:
-                matcher.set_seq2(requested_title.lower())
-                ratio = matcher.ratio()
-
-                # Propose as our new candidate if its ratio is
-                # better than threshold and it's better than
-                # what we've seen yet
-                if ratio > 0.7 and ratio > best_candidate[1]:
-                    best_candidate = (fullpath, ratio)
-
-        return best_candidate[0]
+            if self.library.similarity(title, self.get_show_titles(show)) > 0.7:
+                self.data_handler.set_show_attr(show, 'neweps', True)
+                self._emit_signal('show_changed', show)
+    
+    def _search_video(self, titles, episode):
+        return self._get_library().find(titles, episode)
     
     def get_new_episodes(self, showlist):
         results = list()
-        total = len(showlist)
+        
+        # Look for the next episode of every show at once
+        # in an up to date index of the media directory
+        self.msg.info(self.name, "Updating library...")
+        media = self._get_library()
+        
+        wanted = [ (i, self.get_show_titles(show), show['my_progress']+1)
+                   for i, show in enumerate(showlist) ]
+        found = media.find_all(wanted)
         
         for i, show in enumerate(showlist):
-            self.msg.info(self.name, "Searching %d/%d..." % (i+1, total))
-
-            titles = self.get_show_titles(show)
-
-            filename = self._search_video(titles, show['my_progress']+1)
-            if filename:
+            if i in found:
                 self.data_handler.set_show_attr(show, 'neweps', True)
                 results.append(show)
         return results
@@ -635,6 +694,11 @@ class Engine:
             else:
                 self.data_handler.altname_set(showid, newname)
                 self.msg.info(self.name, 'Changed alternate name to %s.' % newname)
+            
+            # The show is known by other titles now
+            show = self.data_handler.get().get(showid)
+            if show:
+                self._update_tracker(show)
         else:
             return self.data_handler.altname_get(showid)
 
@@ -655,6 +719,9 @@ class Engine:
     def list_download(self):
         """Asks the data handler to download the remote list."""
         self.data_handler.download_data()
+        
+        # Update the tracker with the new information
+        self._update_tracker()
     
     def list_upload(self):
         """Asks the data handler to upload the unsynced changes in the queue."""
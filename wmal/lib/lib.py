@@ -16,6 +16,184 @@
 
 import wmal.utils as utils
 
+import errno
+import hashlib
+import httplib
+import random
+import socket
+import threading
+import time
+import urllib2
+from cStringIO import StringIO
+
+class TokenBucket(object):
+    """
+    Paces requests to an average of **rate** per second,
+    allowing bursts of up to **burst** requests.
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request can be made."""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class ConnectionPool(object):
+    """
+    Keeps HTTP/1.1 connections open after a request so the next
+    request to the same host doesn't have to connect again.
+
+    Up to **size** idle connections are kept per host, and they're
+    dropped after **idle_timeout** seconds without being used.
+    """
+    def __init__(self, size, idle_timeout):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.idle = dict()
+        self.lock = threading.Lock()
+
+        # Counters
+        self.created = 0
+        self.reused = 0
+
+    def get(self, scheme, host, timeout, tunnel_host=None, tunnel_headers=None):
+        """
+        Returns a (connection, reused) tuple with an idle connection
+        to **host**, or a new one if there's none available.
+
+        If **tunnel_host** is given, **host** is a proxy and new connections
+        go through it to **tunnel_host** with a CONNECT request.
+        """
+        now = time.time()
+        with self.lock:
+            conns = self.idle.get((scheme, host, tunnel_host), [])
+            while conns:
+                conn, last_used = conns.pop()
+                if now - last_used < self.idle_timeout:
+                    self.reused += 1
+                    self._set_timeout(conn, timeout)
+                    return (conn, True)
+                conn.close()
+            self.created += 1
+
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, timeout=timeout)
+        else:
+            conn = httplib.HTTPConnection(host, timeout=timeout)
+        if tunnel_host:
+            conn.set_tunnel(tunnel_host, headers=tunnel_headers)
+        return (conn, False)
+
+    def put(self, scheme, host, conn, tunnel_host=None):
+        """Returns a connection to the pool once its response was read."""
+        with self.lock:
+            conns = self.idle.setdefault((scheme, host, tunnel_host), [])
+            if len(conns) < self.size:
+                conns.append((conn, time.time()))
+                return
+        conn.close()
+
+    def close(self):
+        """Closes all idle connections."""
+        with self.lock:
+            for conns in self.idle.itervalues():
+                for conn, last_used in conns:
+                    conn.close()
+            self.idle.clear()
+
+    def _set_timeout(self, conn, timeout):
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+        conn.timeout = timeout
+        if conn.sock:
+            conn.sock.settimeout(timeout)
+
+class KeepAliveHandler(object):
+    """
+    Mixin for urllib2 handlers that sends requests through a
+    :class:`ConnectionPool` instead of opening a new connection every time.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        super(KeepAliveHandler, self).__init__()
+
+    def _keepalive_open(self, scheme, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        headers['Connection'] = 'keep-alive'
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        # HTTPS through a proxy; the proxy credentials
+        # only go in the CONNECT request
+        tunnel_host = req._tunnel_host
+        tunnel_headers = dict()
+        if tunnel_host and 'Proxy-Authorization' in headers:
+            tunnel_headers['Proxy-Authorization'] = headers.pop('Proxy-Authorization')
+
+        while True:
+            conn, reused = self.pool.get(scheme, host, req.timeout, tunnel_host, tunnel_headers)
+            try:
+                conn.request(req.get_method(), req.get_selector(), req.data, headers)
+                r = conn.getresponse()
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                # The server may have closed an idle connection on its
+                # side; only then try again with a new one, as the
+                # request surely wasn't handled.
+                if not (reused and self._is_stale(e)):
+                    raise urllib2.URLError(e)
+                continue
+
+            try:
+                body = r.read()
+                break
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                raise urllib2.URLError(e)
+
+        if r.will_close:
+            conn.close()
+        else:
+            self.pool.put(scheme, host, conn, tunnel_host)
+
+        resp = urllib2.addinfourl(StringIO(body), r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+    def _is_stale(self, error):
+        """Decides if **error** means the connection was closed before we got any answer."""
+        if isinstance(error, httplib.BadStatusLine):
+            return True
+        return isinstance(error, socket.error) and error.errno in (errno.ECONNRESET, errno.EPIPE)
+
+class KeepAliveHTTPHandler(KeepAliveHandler, urllib2.HTTPHandler):
+    def http_open(self, req):
+        return self._keepalive_open('http', req)
+
+class KeepAliveHTTPSHandler(KeepAliveHandler, urllib2.HTTPSHandler):
+    def https_open(self, req):
+        return self._keepalive_open('https', req)
+
 class lib(object):
     """
     Base interface for creating API implementations for wMAL.
@@ -58,6 +236,51 @@ class lib(object):
     
     default_mediatype = None
 
+    max_concurrency = 1
+    """
+    Maximum number of requests the API can have in flight at the same time.
+    When it's higher than 1, the Data Handler sends queued changes of different
+    shows from several threads concurrently, so the add, update and delete
+    functions must be thread-safe.
+    """
+
+    rate_limit = None
+    """
+    Request budget for the remote site as a (rate, burst) tuple: on average
+    *rate* requests per second, with bursts of up to *burst* requests.
+    It's shared by every instance of the same API. None means no limit.
+    """
+
+    max_retries = 3
+    backoff_base = 1.0
+    backoff_max = 60.0
+    """
+    Failed requests are retried up to **max_retries** times, waiting a random
+    time up to **backoff_base** seconds doubled on every attempt, and never
+    more than **backoff_max** seconds.
+    """
+
+    pool_size = 2
+    pool_idle_timeout = 30
+    """
+    HTTP connections are kept open and reused between requests; up to
+    **pool_size** idle connections per host are kept, for at most
+    **pool_idle_timeout** seconds. They're shared by every instance of
+    the same API.
+    """
+
+    validators = None
+    """
+    Dictionary with the validators (ETag, Last-Modified and content hash)
+    of the last list downloaded, set and stored by the Data Handler.
+    HTTP APIs can use them to skip downloading a list that didn't change
+    through :func:`_open_if_changed`.
+    """
+
+    _buckets = dict()
+    _buckets_lock = threading.Lock()
+    _pools = dict()
+
     # Supported signals for the data handler
     signals = { 'show_info_changed': None, }
     
@@ -77,6 +300,130 @@ class lib(object):
         self.api_info['mediatype'] = self.mediatype
         self.api_info['supported_mediatypes'] = self.mediatypes.keys()
 
+    def _throttle(self):
+        """Waits until the rate limit of the API allows another request."""
+        if not self.rate_limit:
+            return
+
+        with self._buckets_lock:
+            if self.name not in self._buckets:
+                self._buckets[self.name] = TokenBucket(*self.rate_limit)
+            bucket = self._buckets[self.name]
+
+        bucket.acquire()
+
+    def _get_pool(self):
+        with self._buckets_lock:
+            if self.name not in self._pools:
+                self._pools[self.name] = ConnectionPool(self.pool_size, self.pool_idle_timeout)
+            return self._pools[self.name]
+
+    def _build_opener(self, *handlers):
+        """
+        Builds an urllib2 opener with the given **handlers** that
+        reuses connections through the connection pool of the API.
+        """
+        pool = self._get_pool()
+        return urllib2.build_opener(KeepAliveHTTPHandler(pool), KeepAliveHTTPSHandler(pool), *handlers)
+
+    def connection_stats(self):
+        """Returns a (created, reused) tuple with the connection counters of the API."""
+        pool = self._get_pool()
+        return (pool.created, pool.reused)
+
+    def _backoff(self, attempt, minimum=0):
+        """Sleeps before retry number **attempt** using a jittered exponential backoff."""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        delay = max(delay, minimum)
+        self.msg.debug(self.name, "Retrying in %.1f seconds..." % delay)
+        time.sleep(delay)
+
+    def _is_transient(self, error, idempotent=True):
+        """
+        Decides if a failed request is worth retrying. Requests that aren't
+        **idempotent** are only retried if the server surely didn't act on them.
+        """
+        if isinstance(error, urllib2.HTTPError):
+            if not idempotent:
+                return error.code in (429, 503)
+            return error.code == 429 or error.code >= 500
+
+        if not idempotent:
+            # Only if we couldn't even connect; after a timeout
+            # the request might have been handled already
+            reason = getattr(error, 'reason', error)
+            return isinstance(reason, socket.gaierror) or getattr(reason, 'errno', None) == errno.ECONNREFUSED
+        return isinstance(error, (urllib2.URLError, socket.error, httplib.HTTPException))
+
+    def _retry(self, func, *args, **kwargs):
+        """
+        Calls **func** with the given arguments within the rate limit of the API.
+        If it fails with a transient error (HTTP 429, HTTP 5xx or a connection error)
+        it's called again after a backoff, up to **max_retries** times.
+
+        Pass idempotent=False for requests that change something remotely
+        and mustn't be sent twice, like adding a show.
+        """
+        idempotent = kwargs.pop('idempotent', True)
+        attempt = 0
+        while True:
+            self._throttle()
+            try:
+                return func(*args, **kwargs)
+            except Exception, e:
+                if attempt >= self.max_retries or not self._is_transient(e, idempotent):
+                    raise
+
+                self.msg.warn(self.name, "Request failed (%s), retrying..." % e)
+
+                # Respect the wait time asked by the server, if any
+                retry_after = 0
+                if isinstance(e, urllib2.HTTPError):
+                    try:
+                        retry_after = float(e.headers.get('Retry-After', 0))
+                    except ValueError:
+                        pass
+
+                self._backoff(attempt, retry_after)
+                attempt += 1
+
+    def _open_if_changed(self, request, timeout):
+        """
+        Opens the urllib2 **request** only if the content changed since the last
+        time it was downloaded, according to the stored validators, giving up
+        on a stalled connection after **timeout** seconds.
+
+        Returns the content, or None if it didn't change.
+        """
+        if self.validators is None:
+            self.validators = dict()
+
+        if self.validators.get('etag'):
+            request.add_header('If-None-Match', self.validators['etag'])
+        if self.validators.get('last_modified'):
+            request.add_header('If-Modified-Since', self.validators['last_modified'])
+
+        try:
+            response = self._retry(self.opener.open, request, timeout=timeout)
+        except urllib2.HTTPError, e:
+            if e.code == 304:
+                return None
+            raise
+
+        # Not every server sends validators, so compare
+        # the content with the last one as a last resort
+        content = response.read()
+        digest = hashlib.sha1(content).hexdigest()
+        if digest == self.validators.get('hash'):
+            return None
+
+        self.validators = {
+            'etag': response.info().getheader('ETag'),
+            'last_modified': response.info().getheader('Last-Modified'),
+            'hash': digest,
+        }
+        return content
+
     def _emit_signal(self, signal, args=None):
         try:
             if self.signals[signal]:
@@ -100,6 +447,9 @@ class lib(object):
 
         It should return a dictionary with the show ID as the key and a show dictionary as its value.
         You can create an empty show dictionary with the :func:`utils.show` function.
+
+        It can also return None if the list didn't change since the last time
+        it was fetched, according to :attr:`validators`.
         """
         raise NotImplementedError
     
@@ -142,6 +492,10 @@ class lib(object):
         # This is called whenever the API won't be required
         # for a good while
         pass
+    
+    def close(self):
+        # This is called when the API won't be used anymore
+        pass
         
     def media_info(self):
         """Return information about the currently selected mediatype."""
@@ -39,6 +39,8 @@ class libhb(lib):
     logged_in = False
     
     api_info =  { 'name': 'Hummingbird', 'version': 'v0.2', 'merge': False }
+    max_concurrency = 4
+    rate_limit = (2, 5)
     
     default_mediatype = 'anime'
     mediatypes = dict()
@@ -71,7 +73,7 @@ class libhb(lib):
         self.password = account['password']
 
         # Build opener with the mashape API key
-        self.opener = urllib2.build_opener()
+        self.opener = self._build_opener()
         self.opener.addheaders = [('X-Mashape-Authorization', self.mashape_auth)]
         
     def _request(self, url, get=None, post=None):
@@ -81,7 +83,7 @@ class libhb(lib):
             post = urllib.urlencode(post)
 
         try:
-            return self.opener.open(self.url + url, post, 10)
+            return self._retry(self.opener.open, self.url + url, post, 10, idempotent=post is None)
         except urllib2.URLError, e:
             raise utils.APIError("Connection error: %s" % e) 
    
@@ -106,8 +108,13 @@ class libhb(lib):
         self.msg.info(self.name, 'Downloading list...')
         
         try:
-            data = self._request( "/users/%s/library" % self.username, get={'auth_token': self.auth} )
-            shows = json.load(data)
+            request = urllib2.Request(self.url + "/users/%s/library?%s" % (self.username, urllib.urlencode({'auth_token': self.auth})))
+            data = self._open_if_changed(request, 10)
+            if data is None:
+                self.msg.info(self.name, 'List unchanged.')
+                return None
+            
+            shows = json.loads(data)
             
             showlist = dict()
             infolist = list()
@@ -138,6 +145,8 @@ class libhb(lib):
             return showlist
         except urllib2.HTTPError, e:
             raise utils.APIError("Error getting list.")
+        except urllib2.URLError, e:
+            raise utils.APIError("Connection error: %s" % e)
     
     def add_show(self, item):
         """Adds a new show in the server"""
@@ -21,6 +21,8 @@ import wmal.utils as utils
 
 import urllib, urllib2
 import datetime
+import threading
+import Queue
 import base64
 import gzip
 import xml.etree.ElementTree as ET
@@ -43,6 +45,8 @@ class libmal(lib):
     opener = None
     
     api_info =  { 'name': 'MyAnimeList', 'version': 'v0.3', 'merge': False }
+    max_concurrency = 4
+    rate_limit = (2, 5)
     
     default_mediatype = 'anime'
     mediatypes = dict()
@@ -92,7 +96,7 @@ class libmal(lib):
         self.username = account['username']
         auth_string = 'Basic ' + base64.encodestring('%s:%s' % (account['username'], account['password'])).replace('\n', '')
 
-        self.opener = urllib2.build_opener()
+        self.opener = self._build_opener()
         self.opener.addheaders = [
 			('User-Agent', self.useragent),
 			('Authorization', auth_string),
@@ -100,25 +104,31 @@ class libmal(lib):
     
     def _request(self, url):
         try:
-            return self.opener.open(url, timeout = 10)
+            return self._retry(self.opener.open, url, timeout = 10)
         except urllib2.URLError, e:
             raise utils.APIError("Connection error: %s" % e) 
 
-    def _request_gzip(self, url):
+    def _request_gzip(self, url, revalidate=False):
         """
         Requests the page as gzip and uncompresses it
 
-        Returns a stream object
+        Returns a stream object, or None if **revalidate** is set
+        and the page didn't change since the last time.
 
         """
         try:
             request = urllib2.Request(url)
             request.add_header('Accept-Encoding', 'gzip')
-            compressed_data = self.opener.open(request)
+            if revalidate:
+                compressed_data = self._open_if_changed(request, 10)
+                if compressed_data is None:
+                    return None
+            else:
+                compressed_data = self._retry(self.opener.open, request, timeout = 10).read()
         except urllib2.URLError, e:
             raise utils.APIError("Connection error: %s" % e)
 
-        compressed_stream = StringIO(compressed_data.read())
+        compressed_stream = StringIO(compressed_data)
         return gzip.GzipFile(fileobj=compressed_stream)
 
     def _make_parser(self):
@@ -164,20 +174,14 @@ class libmal(lib):
         
         try:
             # Get an XML list from MyAnimeList API
-            data = self._request_gzip("http://myanimelist.net/malappinfo.php?u="+self.username+"&status=all&type="+self.mediatype)
+            data = self._request_gzip("http://myanimelist.net/malappinfo.php?u="+self.username+"&status=all&type="+self.mediatype, True)
+            if data is None:
+                self.msg.info(self.name, 'List unchanged.')
+                return None
             
             # Parse the XML data and load it into a dictionary
-            # using the proper function (anime or manga)
-            root = ET.ElementTree().parse(data, parser=self._make_parser())
-            
-            if self.mediatype == 'anime':
-                self.msg.info(self.name, 'Parsing anime list...')
-                return self._parse_anime(root)
-            elif self.mediatype == 'manga':
-                self.msg.info(self.name, 'Parsing manga list...')
-                return self._parse_manga(root)
-            else:
-                raise utils.APIFatal('Attempted to parse unsupported media type.')
+            self.msg.info(self.name, 'Parsing %s list...' % self.mediatype)
+            return self.parse_list(data)
         except urllib2.HTTPError, e:
             raise utils.APIError("Error getting list.")
         except IOError, e:
@@ -194,10 +198,12 @@ class libmal(lib):
         values = {'data': xml}
         data = self._urlencode(values)
         try:
-            response = self.opener.open(self.url + self.mediatype + "list/add/" + str(item['id']) + ".xml", data)
+            response = self._retry(self.opener.open, self.url + self.mediatype + "list/add/" + str(item['id']) + ".xml", data, idempotent=False)
             return True
         except urllib2.HTTPError, e:
             raise utils.APIError('Error adding: ' + str(e.code))
+        except urllib2.URLError, e:
+            raise utils.APIError("Connection error: %s" % e)
         
     def update_show(self, item):
         """Sends a show update to the server"""
@@ -210,10 +216,12 @@ class libmal(lib):
         values = {'data': xml}
         data = self._urlencode(values)
         try:
-            response = self.opener.open(self.url + self.mediatype + "list/update/" + str(item['id']) + ".xml", data)
+            response = self._retry(self.opener.open, self.url + self.mediatype + "list/update/" + str(item['id']) + ".xml", data, idempotent=False)
             return True
         except urllib2.HTTPError, e:
             raise utils.APIError('Error updating: ' + str(e.code))
+        except urllib2.URLError, e:
+            raise utils.APIError("Connection error: %s" % e)
     
     def delete_show(self, item):
         """Sends a show delete to the server"""
@@ -221,13 +229,20 @@ class libmal(lib):
         self.msg.info(self.name, "Deleting show %s..." % item['title'])
         
         try:
-            response = self.opener.open(self.url + self.mediatype + "list/delete/" + str(item['id']) + ".xml")
+            response = self._retry(self.opener.open, self.url + self.mediatype + "list/delete/" + str(item['id']) + ".xml")
             return True
         except urllib2.HTTPError, e:
             raise utils.APIError('Error deleting: ' + str(e.code))
+        except urllib2.URLError, e:
+            raise utils.APIError("Connection error: %s" % e)
         
     def search(self, criteria):
         """Searches MyAnimeList database for the queried show"""
+        entries = self._search(criteria)
+        self._emit_signal('show_info_changed', entries)
+        return entries
+    
+    def _search(self, criteria):
         self.msg.info(self.name, "Searching for %s..." % criteria)
         
         # Send the urlencoded query to the search API
@@ -281,7 +296,6 @@ class libmal(lib):
             })
             entries.append(show)
         
-        self._emit_signal('show_info_changed', entries)
         return entries
     
     def _translate_synopsis(self, string):
@@ -291,14 +305,53 @@ class libmal(lib):
             return string.replace('<br />', '')
 
     def request_info(self, itemlist):
-        resultdict = dict()
+        """
+        Gets the details of the shows in **itemlist** by searching their titles.
+        Every title is searched only once, and several of them at the same time.
+        """
+        titles = []
         for item in itemlist:
-            # Search for it only if it hasn't been found earlier
-            if item['id'] not in resultdict:
-                infos = self.search(item['title'])
+            if item['title'] not in titles:
+                titles.append(item['title'])
+
+        resultdict = dict()
+        error = None
+        workers = min(self.max_concurrency, len(titles))
+        if workers > 1:
+            tasks = Queue.Queue()
+            results = Queue.Queue()
+            for title in titles:
+                tasks.put(title)
+
+            for i in range(workers):
+                worker = threading.Thread(target=self._search_worker, args=(tasks, results))
+                worker.daemon = True
+                worker.start()
+
+            for title in titles:
+                (infos, e) = results.get()
+                if e:
+                    error = e
+                    continue
+                for info in infos:
+                    resultdict[info['id']] = info
+        else:
+            for title in titles:
+                try:
+                    infos = self._search(title)
+                except utils.APIError, e:
+                    error = e
+                    break
                 for info in infos:
-                    showid = info['id']
-                    resultdict[showid] = info
+                    resultdict[info['id']] = info
+
+        # Every show found goes to the info cache, even the ones
+        # we didn't ask for; they'll probably be requested later.
+        if resultdict:
+            self._emit_signal('show_info_changed', resultdict.values())
+
+        if error:
+            raise error
 
         itemids = [ show['id'] for show in itemlist ]
 
@@ -309,65 +362,98 @@ class libmal(lib):
 
         return reslist
 
-    def _parse_anime(self, root):
-        """Converts an XML anime list to a dictionary"""
+    def _search_worker(self, tasks, results):
+        while True:
+            try:
+                title = tasks.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                results.put((self._search(title), None))
+            except Exception, e:
+                results.put((None, e))
+
+    def parse_list(self, source):
+        """
+        Converts an XML list to a dictionary, building the shows
+        as the XML is read instead of loading the whole tree first.
+
+        **source** can be a file object or the path of a local XML file.
+        """
+        # Use the proper function (anime or manga)
+        if self.mediatype == 'anime':
+            parse_item = self._parse_anime
+        elif self.mediatype == 'manga':
+            parse_item = self._parse_manga
+        else:
+            raise utils.APIFatal('Attempted to parse unsupported media type.')
+        
         showlist = dict()
-        for child in root.iter('anime'):
-            show_id = int(child.find('series_animedb_id').text)
-            if child.find('series_synonyms').text:
-                aliases = child.find('series_synonyms').text.lstrip('; ').split('; ')
-            else:
-                aliases = []
-            
-            show = utils.show()
-            show.update({
-                'id':           show_id,
-                'title':        child.find('series_title').text,
-                'aliases':      aliases,
-                'my_progress':  int(child.find('my_watched_episodes').text),
-                'my_status':    int(child.find('my_status').text),
-                'my_score':     int(child.find('my_score').text),
-                'my_start_date':  self._str2date( child.find('my_start_date').text ),
-                'my_finish_date': self._str2date( child.find('my_finish_date').text ),
-                'total':     int(child.find('series_episodes').text),
-                'status':       int(child.find('series_status').text),
-                'start_date':   self._str2date( child.find('series_start').text ),
-                'end_date':     self._str2date( child.find('series_end').text ),
-                'image':        child.find('series_image').text,
-                'url':          "http://myanimelist.net/anime/%d" % show_id,
-            })
-            showlist[show_id] = show
+        context = ET.iterparse(source, events=('start', 'end'), parser=self._make_parser())
+        event, root = context.next()
+        for event, elem in context:
+            if event == 'end' and elem.tag == self.mediatype:
+                show = parse_item(elem)
+                showlist[show['id']] = show
+                
+                # Drop the parsed elements so the tree doesn't grow
+                root.clear()
         return showlist
     
-    def _parse_manga(self, root):
-        """Converts an XML manga list to a dictionary"""
-        mangalist = dict()
-        for child in root.iter('manga'):
-            manga_id = int(child.find('series_mangadb_id').text)
-            if child.find('series_synonyms').text:
-                aliases = child.find('series_synonyms').text.lstrip('; ').split('; ')
-            else:
-                aliases = []
-            
-            show = utils.show()
-            show.update({
-                'id':           manga_id,
-                'title':        child.find('series_title').text,
-                'aliases':      aliases,
-                'my_progress':  int(child.find('my_read_chapters').text),
-                'my_status':    int(child.find('my_status').text),
-                'my_score':     int(child.find('my_score').text),
-                'my_start_date':  self._str2date( child.find('my_start_date').text ),
-                'my_finish_date': self._str2date( child.find('my_finish_date').text ),
-                'total':     int(child.find('series_chapters').text),
-                'status':       int(child.find('series_status').text),
-                'start_date':   self._str2date( child.find('series_start').text ),
-                'end_date':     self._str2date( child.find('series_end').text ),
-                'image':        child.find('series_image').text,
-                'url':          "http://myanimelist.net/manga/%d" % manga_id,
-            })
-            mangalist[manga_id] = show
-        return mangalist
+    def _parse_anime(self, child):
+        """Converts an XML anime element to a show dictionary"""
+        show_id = int(child.find('series_animedb_id').text)
+        if child.find('series_synonyms').text:
+            aliases = child.find('series_synonyms').text.lstrip('; ').split('; ')
+        else:
+            aliases = []
+        
+        show = utils.show()
+        show.update({
+            'id':           show_id,
+            'title':        child.find('series_title').text,
+            'aliases':      aliases,
+            'my_progress':  int(child.find('my_watched_episodes').text),
+            'my_status':    int(child.find('my_status').text),
+            'my_score':     int(child.find('my_score').text),
+            'my_start_date':  self._str2date( child.find('my_start_date').text ),
+            'my_finish_date': self._str2date( child.find('my_finish_date').text ),
+            'total':     int(child.find('series_episodes').text),
+            'status':       int(child.find('series_status').text),
+            'start_date':   self._str2date( child.find('series_start').text ),
+            'end_date':     self._str2date( child.find('series_end').text ),
+            'image':        child.find('series_image').text,
+            'url':          "http://myanimelist.net/anime/%d" % show_id,
+        })
+        return show
+    
+    def _parse_manga(self, child):
+        """Converts an XML manga element to a show dictionary"""
+        manga_id = int(child.find('series_mangadb_id').text)
+        if child.find('series_synonyms').text:
+            aliases = child.find('series_synonyms').text.lstrip('; ').split('; ')
+        else:
+            aliases = []
+        
+        show = utils.show()
+        show.update({
+            'id':           manga_id,
+            'title':        child.find('series_title').text,
+            'aliases':      aliases,
+            'my_progress':  int(child.find('my_read_chapters').text),
+            'my_status':    int(child.find('my_status').text),
+            'my_score':     int(child.find('my_score').text),
+            'my_start_date':  self._str2date( child.find('my_start_date').text ),
+            'my_finish_date': self._str2date( child.find('my_finish_date').text ),
+            'total':     int(child.find('series_chapters').text),
+            'status':       int(child.find('series_status').text),
+            'start_date':   self._str2date( child.find('series_start').text ),
+            'end_date':     self._str2date( child.find('series_end').text ),
+            'image':        child.find('series_image').text,
+            'url':          "http://myanimelist.net/manga/%d" % manga_id,
+        })
+        return show
     
     def _build_xml(self, item):
         """
@@ -30,6 +30,8 @@ class libmelative(lib):
     name = 'libmelative'
     
     api_info =  { 'name': 'Melative', 'version': 'v0.1', 'merge': False }
+    max_concurrency = 2
+    rate_limit = (1, 3)
     
     mediatypes = dict()
     
@@ -97,7 +99,7 @@ class libmelative(lib):
         self.password_mgr.add_password("Melative", "melative.com:80", account['username'], account['password']);
         
         self.handler = urllib2.HTTPBasicAuthHandler(self.password_mgr)
-        self.opener = urllib2.build_opener(self.handler)
+        self.opener = self._build_opener(self.handler)
         
         urllib2.install_opener(self.opener)
         
@@ -105,7 +107,7 @@ class libmelative(lib):
         self.msg.info(self.name, 'Logging in...')
         
         try:
-            response = self.opener.open("http://melative.com/api/account/verify_credentials.json")
+            response = self._retry(self.opener.open, "http://melative.com/api/account/verify_credentials.json")
             self.logged_in = True
             
             # Parse user information
@@ -123,8 +125,13 @@ class libmelative(lib):
         self.msg.info(self.name, 'Downloading list...')
         
         # Get a JSON list from API
-        response = self.opener.open("http://melative.com/api/library.json?user={0}&context_type={1}".format(self.username, self.mediatype))
-        data = json.load(response)
+        request = urllib2.Request("http://melative.com/api/library.json?user={0}&context_type={1}".format(self.username, self.mediatype))
+        response = self._open_if_changed(request, 10)
+        if response is None:
+            self.msg.info(self.name, 'List unchanged.')
+            return None
+        
+        data = json.loads(response)
         
         # Load data from the JSON stream into a parsed dictionary
         statuses = self.media_info()['statuses_dict']
@@ -196,7 +203,7 @@ class libmelative(lib):
         data = self._urlencode(changes)
 
         try:
-            response = self.opener.open("http://melative.com/api/scrobble.json", data)
+            response = self._retry(self.opener.open, "http://melative.com/api/scrobble.json", data, idempotent=False)
         except urllib2.HTTPError, e:
             raise utils.APIError("Error updating: " + str(e.code))
         
@@ -20,6 +20,8 @@ import wmal.utils as utils
 import socket
 import json
 import datetime
+import threading
+import time
 
 class libvndb(lib):
     """
@@ -39,6 +41,22 @@ class libvndb(lib):
                   'merge': True,
                 }
     
+    # The server throttles clients sending too many commands
+    rate_limit = (1, 10)
+    
+    host = 'api.vndb.org'
+    port = 19534
+    recv_size = 65536
+    
+    # Largest page allowed by the protocol, and how many
+    # commands to send before waiting for their responses
+    page_size = 25
+    pipeline_depth = 4
+    
+    # Seconds to keep the session open without being used
+    session_timeout = 300
+    socket_timeout = 30
+    
     default_mediatype = 'vnlist'
     mediatypes = dict()
     mediatypes['vnlist'] = {
@@ -76,65 +94,45 @@ class libvndb(lib):
         self.password = account['password']
         self.logged_in = False
         
+        self.s = None
+        self.buffer = ""
+        self.decoder = json.JSONDecoder()
+        self.last_used = 0
+        self.idle_timer = None
+        
+        # Only one command can be going through the socket at a time
+        self.lock = threading.RLock()
+        
     def _connect(self):
         """Create TCP socket and connect"""
         try:
             self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.s.connect(("api.vndb.org", 19534))
+            self.s.settimeout(self.socket_timeout)
+            self.s.connect((self.host, self.port))
         except socket.error:
+            self.s = None
             raise utils.APIError("Connection error.")
     
     def _disconnect(self):
         """Shutdown and close the socket"""
-        self.s.shutdown(socket.SHUT_RDWR)
-        self.s.close()
-    
-    def _sendcmd(self, cmd, options=None):
-        """Send a VNDB compatible command and return the response data"""
-        msg = cmd
-        if options:
-            msg += " " + json.dumps(options, separators=(',',':'))
-        msg += "\x04" # EOT
-        
-        # Send message
-        self.s.sendall(msg)
-        
-        # Construct response
-        lines = []
-        while True:
-            line = self.s.recv(65536)
-            if line.endswith("\x04"):
-                line = line.strip("\x04")
-                lines.append(line)
-                response = "".join(lines)
-                break
-            else:
-                lines.append(line)
-        
-        # Separate into response name and JSON data
-        _resp = response.split(' ', 1)
-        name = _resp[0]
-        try:
-            data = json.loads(_resp[1])
-        except IndexError:
-            data = None
-        
-        # Treat error as an exception
-        if name == 'error':
-            raise utils.APIError(data['msg'])
-        
-        return (name, data)
-        
-    def check_credentials(self):
-        """Checks if credentials are correct; returns True or False."""
-        if self.logged_in:
-            return True
+        if self.s:
+            try:
+                self.s.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass # It may be closed already
+            self.s.close()
         
+        self.s = None
+        self.buffer = ""
+        self.logged_in = False
+    
+    def _login(self):
+        """Opens a new session with the server"""
         self.msg.info(self.name, 'Connecting...')
         self._connect()
         
         self.msg.info(self.name, 'Logging in...')
-        (name, data) = self._sendcmd('login',
+        (name, data) = self._command('login',
             {'protocol': 1,
              'client': 'wMAL',
              'clientver': self.api_info['version'],
@@ -144,99 +142,246 @@ class libvndb(lib):
         
         if name == 'ok':
             self.logged_in = True
-            return True
         else:
-            return False
+            self._disconnect()
+            if name == 'error':
+                raise utils.APIError(data['msg'])
+        
+        return self.logged_in
     
-    def fetch_list(self):
-        """Queries the full list from the remote server.
-        Returns the list if successful, False otherwise."""
-        self.check_credentials()
+    def _sendcmd(self, cmd, options=None):
+        """Send a VNDB compatible command and return the response data"""
+        return self._sendcmds([(cmd, options)])[0]
+    
+    def _sendcmds(self, commands):
+        """
+        Send several (command, options) tuples one after another without
+        waiting for each response, and return their responses in order.
         
-        # Retrieve VNs per pages
-        page = 1
-        vns = dict()
+        If the connection was lost, or the server forgot our session,
+        it connects and logs in again and resends the commands once.
+        Commands throttled by the server are resent after a wait.
+        """
+        with self.lock:
+            responses = [None] * len(commands)
+            pending = range(len(commands))
+            retried = False
+            attempt = 0
+            while pending:
+                if not self.logged_in:
+                    self._login()
+                
+                try:
+                    for i in pending:
+                        self._throttle()
+                        self.s.sendall(self._build_msg(*commands[i]))
+                    self.last_used = time.time()
+                    
+                    results = [ self._read_response() for i in pending ]
+                except socket.error, e:
+                    self._disconnect()
+                    if retried:
+                        raise utils.APIError("Connection error: %s" % e)
+                    
+                    self.msg.warn(self.name, 'Connection lost, reconnecting...')
+                    retried = True
+                    continue
+                
+                throttled = []
+                minwait = 0
+                needlogin = False
+                for i, (name, data) in zip(pending, results):
+                    if name == 'error' and data.get('id') == 'throttled':
+                        throttled.append(i)
+                        minwait = max(minwait, data.get('minwait', 0))
+                    elif name == 'error' and data.get('id') == 'needlogin' and not retried:
+                        throttled.append(i)
+                        needlogin = True
+                    elif name == 'error':
+                        # Treat error as an exception
+                        raise utils.APIError(data['msg'])
+                    else:
+                        responses[i] = (name, data)
+                
+                pending = throttled
+                if needlogin:
+                    self._disconnect()
+                    retried = True
+                elif pending:
+                    # The server tells us how long to wait if we're going too fast
+                    if attempt >= self.max_retries:
+                        raise utils.APIError("Throttled by the server.")
+                    
+                    self.msg.warn(self.name, "Throttled by the server, waiting...")
+                    self._backoff(attempt, minwait)
+                    attempt += 1
+            
+            return responses
+    
+    def _command(self, cmd, options=None):
+        """Sends a single command through the socket and reads its response"""
+        msg = self._build_msg(cmd, options)
+        
+        attempt = 0
         while True:
-            self.msg.info(self.name, 'Downloading list... (%d)' % page)
+            # Send message
+            self._throttle()
+            self.s.sendall(msg)
+            self.last_used = time.time()
             
-            (name, data) = self._sendcmd('get %s basic (uid = 0)' % self.mediatype,
-                {'page': page,
-                'results': 25
-                })
-        
-            # Something is wrong if we don't get a results response.
-            if name != 'results':
-                raise utils.APIFatal("Invalid response (%s)" % name)
+            (name, data) = self._read_response()
             
-            # Process list
-            for item in data['items']:
-                vnid = item['vn']
-                vns[vnid] = utils.show()
-                vns[vnid]['id']         = vnid
-                vns[vnid]['url'] = self._get_url(vnid)
-                vns[vnid]['my_status']  = item.get('status', item.get('priority'))
+            # The server tells us how long to wait if we're going too fast
+            if name == 'error' and data.get('id') == 'throttled' and attempt < self.max_retries:
+                self.msg.warn(self.name, "Throttled by the server, waiting...")
+                self._backoff(attempt, data.get('minwait', 0))
+                attempt += 1
+                continue
             
-            if not data['more']:
-                # No more VNs, finish
-                break
-            page += 1
+            return (name, data)
+    
+    def _build_msg(self, cmd, options=None):
+        msg = cmd
+        if options:
+            msg += " " + json.dumps(options, separators=(',',':'))
+        msg += "\x04" # EOT
+        return msg
+    
+    def _read_response(self):
+        """Reads a response and separates it into response name and JSON data"""
+        response = self._read_frame()
+        sep = response.find(' ')
+        if sep == -1:
+            return (response, None)
+        else:
+            return (response[:sep], self.decoder.raw_decode(response, sep + 1)[0])
+        
+    def _read_frame(self):
+        """
+        Reads a response up to its EOT terminator.
         
-        # Retrieve scores per pages
-        page = 1
+        Only newly received bytes are scanned for the terminator, and
+        anything received after it is kept for the next response.
+        """
+        chunks = []
+        chunk = self.buffer
         while True:
-            self.msg.info(self.name, 'Downloading votes... (%d)' % page)
+            end = chunk.find("\x04")
+            if end != -1:
+                chunks.append(chunk[:end])
+                self.buffer = chunk[end+1:]
+                return "".join(chunks)
             
-            (name, data) = self._sendcmd('get votelist basic (uid = 0)',
-                {'page': page,
-                'results': 25
-                })
+            chunks.append(chunk)
+            chunk = self.s.recv(self.recv_size)
+            if not chunk:
+                raise socket.error("Connection closed by server")
+        
+    def check_credentials(self):
+        """Checks if credentials are correct; returns True or False."""
+        with self.lock:
+            if self.logged_in:
+                return True
+            
+            return self._login()
+    
+    def fetch_list(self):
+        """Queries the full list from the remote server.
+        Returns the list if successful, False otherwise."""
+        self.check_credentials()
+        
+        # Retrieve VNs and their votes per pages at the same time
+        self.msg.info(self.name, 'Downloading list...')
+        items = self._get_pages({
+            'list':  'get %s basic (uid = 0)' % self.mediatype,
+            'votes': 'get votelist basic (uid = 0)',
+        })
+        
+        # Process list
+        vns = dict()
+        for item in items['list']:
+            vnid = item['vn']
+            vns[vnid] = utils.show()
+            vns[vnid]['id']         = vnid
+            vns[vnid]['url'] = self._get_url(vnid)
+            vns[vnid]['my_status']  = item.get('status', item.get('priority'))
+        
+        for item in items['votes']:
+            vnid = item['vn']
+            try:
+                vns[vnid]['my_score'] = (item['vote'] / 10.0)
+            except KeyError:
+                # Ghost vote; ignore it
+                pass
+        
+        return vns
+    
+    def _get_pages(self, streams):
+        """
+        Downloads all pages of the **streams** dictionary of get commands.
+        
+        The next pipeline_depth pages of every stream are requested together
+        in a single round-trip. Returns a dictionary with the items of every
+        stream.
+        """
+        start_time = time.time()
+        commands_sent = 0
+        
+        items = dict((stream, []) for stream in streams)
+        next_page = dict((stream, 1) for stream in streams)
+        remaining = sorted(streams.keys())
+        while remaining:
+            batch = []
+            for stream in remaining:
+                for page in range(next_page[stream], next_page[stream] + self.pipeline_depth):
+                    batch.append((stream, page))
+                next_page[stream] += self.pipeline_depth
             
-            # Something is wrong if we don't get a results response.
-            if name != 'results':
-                raise utils.APIFatal("Invalid response (%s)" % name)
+            responses = self._sendcmds([ (streams[stream], {'page': page, 'results': self.page_size})
+                                         for (stream, page) in batch ])
+            commands_sent += len(batch)
             
-            for item in data['items']:
-                vnid = item['vn']
-                try:
-                    vns[vnid]['my_score'] = (item['vote'] / 10.0)
-                except KeyError:
-                    # Ghost vote; ignore it
-                    pass
+            for (stream, page), (name, data) in zip(batch, responses):
+                # Something is wrong if we don't get a results response.
+                if name != 'results':
+                    raise utils.APIFatal("Invalid response (%s)" % name)
                 
-            if not data['more']:
-                # No more VNs, finish
-                break
-            page += 1
+                if stream in remaining:
+                    items[stream].extend(data['items'])
+                    if not data['more']:
+                        # No more pages in this stream, finish
+                        remaining.remove(stream)
+            
+            self.msg.info(self.name, 'Downloading list... (%d)' % sum(len(l) for l in items.itervalues()))
         
-        return vns
+        elapsed = time.time() - start_time
+        total = sum(len(l) for l in items.itervalues())
+        self.msg.debug(self.name, "Got %d items with %d commands in %.1f seconds (%.1f items/s)." %
+                       (total, commands_sent, elapsed, total / max(elapsed, 0.001)))
+        return items
     
     def request_info(self, itemlist):
         self.check_credentials()
-            
-        start = 0
+        
+        # Ask for the details of page_size VNs per command,
+        # sending pipeline_depth commands at a time
+        ids = [ show['id'] for show in itemlist ]
+        commands = [ ('get vn basic,details (id = %s)' % repr(ids[start:start+self.page_size]),
+                      {'page': 1, 'results': self.page_size})
+                     for start in range(0, len(ids), self.page_size) ]
+        
         infos = list()
-        remaining = [ show['id'] for show in itemlist ]
-        while True:
-            self.msg.info(self.name, 'Requesting details...(%d)' % start)
-            end = start + 25
+        for start in range(0, len(commands), self.pipeline_depth):
+            self.msg.info(self.name, 'Requesting details...(%d)' % (start * self.page_size))
             
-            (name, data) = self._sendcmd('get vn basic,details (id = %s)' % repr(remaining[start:end]),
-                {'page': 1,
-                 'results': 25,
-                })
-            
-            # Something is wrong if we don't get a results response.
-            if name != 'results':
-                raise utils.APIFatal("Invalid response (%s)" % name)
-            
-            # Process list
-            for item in data['items']:
-                infos.append(self._parse_info(item))
-            
-            start += 25
-            if start >= len(itemlist):
-                # We're going beyond the list, finish
-                break
+            for (name, data) in self._sendcmds(commands[start:start+self.pipeline_depth]):
+                # Something is wrong if we don't get a results response.
+                if name != 'results':
+                    raise utils.APIFatal("Invalid response (%s)" % name)
+                
+                # Process list
+                for item in data['items']:
+                    infos.append(self._parse_info(item))
         
         self._emit_signal('show_info_changed', infos)
         return infos
@@ -298,7 +443,7 @@ class libvndb(lib):
         
         (name, data) = self._sendcmd('get vn basic,details (search ~ "%s")' % criteria,
             {'page': 1,
-             'results': 25,
+             'results': self.page_size,
             })
         
         # Something is wrong if we don't get a results response.
@@ -317,9 +462,39 @@ class libvndb(lib):
         return results
     
     def logout(self):
-        self.msg.info(self.name, 'Disconnecting...')
-        self._disconnect()
-        self.logged_in = False
+        # Keep the session open in case it's needed again soon;
+        # it's closed once it has been idle for a while.
+        with self.lock:
+            if self.s and not self.idle_timer:
+                self._start_idle_timer(self.session_timeout)
+    
+    def close(self):
+        with self.lock:
+            if self.idle_timer:
+                self.idle_timer.cancel()
+                self.idle_timer = None
+            
+            if self.s:
+                self.msg.info(self.name, 'Disconnecting...')
+                self._disconnect()
+    
+    def _start_idle_timer(self, interval):
+        self.idle_timer = threading.Timer(interval, self._idle_check)
+        self.idle_timer.daemon = True
+        self.idle_timer.start()
+    
+    def _idle_check(self):
+        with self.lock:
+            self.idle_timer = None
+            if not self.s:
+                return
+            
+            idle = time.time() - self.last_used
+            if idle >= self.session_timeout:
+                self.msg.debug(self.name, 'Session idle, disconnecting...')
+                self._disconnect()
+            else:
+                self._start_idle_timer(self.session_timeout - idle)
 
     def merge(self, show, info):
         show['title'] = info['title']
@@ -0,0 +1,500 @@
+# This file is part of wMAL.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import cPickle
+import ctypes
+import ctypes.util
+import difflib
+import errno
+import os
+import re
+import select
+import struct
+import sys
+import threading
+
+import matcher
+import tracker
+import utils
+
+class MediaLibrary(object):
+    """
+    Index of the video files found in the media directory, so looking for
+    an episode doesn't need to walk the whole directory and analyze
+    every file again.
+
+    Every file is analyzed once and indexed by episode and normalized title.
+    :func:`refresh` only reads again the directories that changed since the
+    last time, and the index is kept on disk between sessions in **cachefile**.
+    """
+    name = 'Library'
+    version = 1
+
+    signals = { 'episode_added': None, }
+
+    def __init__(self, messenger, searchdir, extensions='mkv|mp4|avi', cachefile=None):
+        self.msg = messenger
+        self.searchdir = os.path.expanduser(searchdir)
+        self.extensions = extensions
+        self.cachefile = cachefile
+        self.lock = threading.RLock()
+
+        self._ext_re = re.compile(extensions, re.I)
+
+        # dirs: Directory path -> (mtime, subdirectories, {filename: (title, episode)})
+        # index: Episode -> normalized title -> list of full paths
+        self.dirs = dict()
+        self.index = dict()
+        self.changed = False
+        self.added = []
+
+        if self.cachefile:
+            self._load()
+
+    def set_message_handler(self, message_handler):
+        self.msg = message_handler
+
+    def connect_signal(self, signal, callback):
+        try:
+            self.signals[signal] = callback
+        except KeyError:
+            raise utils.EngineFatal("Invalid signal.")
+
+    def _emit_signal(self, signal, *args):
+        try:
+            if self.signals[signal]:
+                self.signals[signal](*args)
+        except KeyError:
+            raise Exception("Call to undefined signal.")
+
+    def normalize(self, title):
+        """Returns the form of **title** used as key in the index."""
+        return title.lower().strip()
+
+    def refresh(self, path=None):
+        """
+        Brings the index up to date with the media directory, or only
+        with the directory **path** inside it.
+
+        Directories whose modification time didn't change are taken from
+        the index as they are; only new files are analyzed. The episode_added
+        signal is emitted for every new file.
+        """
+        if path is None:
+            path = self.searchdir
+
+        with self.lock:
+            seen = set()
+            (added, removed) = self._refresh_dir(path, seen)
+
+            # Forget directories that don't exist anymore
+            for dirpath in [ dirpath for dirpath in self.dirs if dirpath not in seen and
+                             (dirpath == path or dirpath.startswith(path + os.sep)) ]:
+                removed += self._drop_dir(dirpath)
+
+            if added or removed:
+                self.msg.debug(self.name, "Library updated: %d added, %d removed." % (added, removed))
+
+            new_files = self.added
+            self.added = []
+
+        for (fullpath, (title, episode)) in new_files:
+            self._emit_signal('episode_added', title, episode, fullpath)
+
+    def find(self, titles, episode, threshold=0.7):
+        """
+        Returns the path of the file of **episode** that best matches any of
+        **titles**, or None if there's none similar enough.
+        """
+        with self.lock:
+            candidates = self.index.get(episode)
+            if not candidates:
+                return None
+
+            normalized = [ self.normalize(title) for title in titles ]
+
+            # An exact match is as good as it gets
+            for title in normalized:
+                if title in candidates:
+                    return candidates[title][0]
+
+            best_candidate = (None, 0)
+            for candidate_title, paths in candidates.iteritems():
+                ratio = self.similarity(candidate_title, normalized)
+                if ratio > threshold and ratio > best_candidate[1]:
+                    best_candidate = (paths[0], ratio)
+
+            return best_candidate[0]
+
+    def find_all(self, wanted, threshold=0.7):
+        """
+        Looks for many episodes in a single pass over the library.
+
+        **wanted** is a list of (key, titles, episode) tuples; returns a
+        dictionary with the key and the file path of every one found.
+        """
+        # Group the requests by episode and title, so every
+        # file is only compared against the shows that want it
+        by_episode = dict()
+        for (key, titles, episode) in wanted:
+            normalized = [ self.normalize(title) for title in titles ]
+            by_episode.setdefault(episode, []).append((key, normalized))
+
+        found = dict()
+        with self.lock:
+            total = sum(len(paths) for episode in by_episode
+                        for paths in self.index.get(episode, {}).itervalues())
+            (done, reported) = (0, 0)
+
+            for episode, requests in by_episode.iteritems():
+                candidates = self.index.get(episode, {})
+
+                # An exact match is as good as it gets
+                pending = []
+                for (key, normalized) in requests:
+                    for title in normalized:
+                        if title in candidates:
+                            found[key] = candidates[title][0]
+                            break
+                    else:
+                        pending.append((key, normalized))
+
+                # Index the titles of the shows still without a file,
+                # so every file is only compared with the closest ones
+                title_matcher = matcher.TitleMatcher(threshold)
+                for (key, normalized) in pending:
+                    title_matcher.add(key, normalized)
+
+                best = dict()
+                for candidate_title, paths in candidates.iteritems():
+                    done += len(paths)
+                    if done - reported >= 500 or done == total:
+                        self.msg.info(self.name, "Searching %d/%d files..." % (done, total))
+                        reported = done
+
+                    if not pending:
+                        continue
+
+                    for (key, ratio) in title_matcher.candidates(candidate_title):
+                        if ratio > best.get(key, (None, 0))[1]:
+                            best[key] = (paths[0], ratio)
+
+                for key, (path, ratio) in best.iteritems():
+                    found[key] = path
+
+        return found
+
+    def similarity(self, candidate_title, titles):
+        """
+        Returns how similar the normalized **candidate_title** is to the
+        closest of **titles**, from 0 to 1.
+        """
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq1(candidate_title)
+
+        # We remember to compare all titles (aliases and whatnot)
+        best = 0
+        for title in titles:
+            matcher.set_seq2(self.normalize(title))
+
+            # The quick upper bounds are enough to rule most titles out
+            if matcher.real_quick_ratio() > best and matcher.quick_ratio() > best:
+                best = max(best, matcher.ratio())
+        return best
+
+    def directories(self):
+        """Returns the paths of all the indexed directories."""
+        with self.lock:
+            return self.dirs.keys()
+
+    def episodes(self, episode):
+        """Returns a dictionary of normalized titles and paths of the files of **episode**."""
+        with self.lock:
+            return dict(self.index.get(episode, {}))
+
+    def save(self):
+        """Writes the index to disk if it changed."""
+        with self.lock:
+            if not self.cachefile or not self.changed:
+                return
+
+            tmpfile = self.cachefile + '.tmp'
+            with open(tmpfile, 'wb') as f:
+                cPickle.dump((self.version, self.searchdir, self.extensions, self.dirs), f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmpfile, self.cachefile)
+            self.changed = False
+
+    def _load(self):
+        try:
+            with open(self.cachefile, 'rb') as f:
+                (version, searchdir, extensions, dirs) = cPickle.load(f)
+        except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+            return
+
+        # Start over if it's the index of something else
+        if version != self.version or searchdir != self.searchdir or extensions != self.extensions:
+            return
+
+        self.dirs = dirs
+        for path, (mtime, subdirs, files) in dirs.iteritems():
+            for filename, entry in files.iteritems():
+                self._index_add(os.path.join(path, filename), entry)
+
+    def _refresh_dir(self, path, seen):
+        (added, removed) = (0, 0)
+
+        # Don't go around in circles with symlinks
+        realpath = os.path.realpath(path)
+        if realpath in seen:
+            return (added, removed)
+        seen.add(path)
+        seen.add(realpath)
+
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return (added, removed)
+
+        if path in self.dirs and self.dirs[path][0] == mtime:
+            subdirs = self.dirs[path][1]
+        else:
+            try:
+                names = os.listdir(path)
+            except OSError:
+                return (added, removed)
+
+            old_files = self.dirs[path][2] if path in self.dirs else dict()
+            files = dict()
+            subdirs = []
+            new_files = []
+            for filename in names:
+                fullpath = os.path.join(path, filename)
+                if os.path.isdir(fullpath):
+                    subdirs.append(filename)
+                    continue
+
+                extension = os.path.splitext(filename)[1][1:]
+                if not self._ext_re.match(extension):
+                    continue
+
+                if filename in old_files:
+                    files[filename] = old_files.pop(filename)
+                else:
+                    new_files.append(filename)
+
+            for filename, entry in zip(new_files, self._analyze(new_files)):
+                fullpath = os.path.join(path, filename)
+                files[filename] = entry
+                self._index_add(fullpath, entry)
+                if entry:
+                    self.added.append((fullpath, entry))
+                added += 1
+
+            for filename, entry in old_files.iteritems():
+                self._index_remove(os.path.join(path, filename), entry)
+                removed += 1
+
+            self.dirs[path] = (mtime, subdirs, files)
+            self.changed = True
+
+        for subdir in subdirs:
+            (sub_added, sub_removed) = self._refresh_dir(os.path.join(path, subdir), seen)
+            added += sub_added
+            removed += sub_removed
+
+        return (added, removed)
+
+    def _drop_dir(self, path):
+        (mtime, subdirs, files) = self.dirs.pop(path)
+        for filename, entry in files.iteritems():
+            self._index_remove(os.path.join(path, filename), entry)
+        self.changed = True
+        return len(files)
+
+    def _analyze(self, filenames):
+        entries = []
+        for aie in tracker.extract_info_many(filenames):
+            (title, episode) = (aie.getName(), aie.getEpisode())
+            if title:
+                entries.append((self.normalize(title), episode))
+            else:
+                entries.append(None)
+        return entries
+
+    def _index_add(self, fullpath, entry):
+        if not entry:
+            return
+        (title, episode) = entry
+        self.index.setdefault(episode, {}).setdefault(title, []).append(fullpath)
+
+    def _index_remove(self, fullpath, entry):
+        if not entry:
+            return
+        (title, episode) = entry
+        try:
+            paths = self.index[episode][title]
+            paths.remove(fullpath)
+        except (KeyError, ValueError):
+            return
+
+        if not paths:
+            del self.index[episode][title]
+            if not self.index[episode]:
+                del self.index[episode]
+
+class LibraryWatcher(object):
+    """
+    Follows the changes in the media directory through Linux inotify,
+    and refreshes the directories of a :class:`MediaLibrary` as soon as
+    files are added, renamed or deleted in them.
+
+    Raises OSError if inotify isn't available.
+    """
+    name = 'Watcher'
+
+    # inotify constants from <sys/inotify.h>
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_NONBLOCK = 0x00000800
+    IN_CLOEXEC = 0x00080000
+
+    WATCH_MASK = (IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                  IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    EVENT = struct.Struct('iIII')
+
+    # Seconds to wait for more events before refreshing,
+    # so a batch of changes is handled at once
+    settle_time = 0.5
+
+    def __init__(self, messenger, library):
+        self.msg = messenger
+        self.library = library
+        self.wds = dict()
+        self.paths = dict()
+        self.running = False
+        self.thread = None
+
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError("C library not found.")
+
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError("inotify is not supported in this system.")
+
+        # Without these, ctypes would pass unicode paths as wchar_t*
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Couldn't initialize inotify.")
+
+    def set_message_handler(self, message_handler):
+        self.msg = message_handler
+
+    def start(self):
+        """Watches all the directories in the library and starts following them."""
+        self._sync_watches()
+
+        self.running = True
+        self.thread = threading.Thread(target=self._watch)
+        self.thread.daemon = True
+        self.thread.start()
+        self.msg.debug(self.name, "Watching %d directories." % len(self.wds))
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        os.close(self.fd)
+
+    def _sync_watches(self):
+        """Watches new directories in the library and forgets removed ones."""
+        directories = set(self.library.directories())
+
+        for path in directories:
+            if path not in self.paths:
+                encoded = path
+                if isinstance(path, unicode):
+                    encoded = path.encode(sys.getfilesystemencoding() or 'utf-8')
+                wd = self.libc.inotify_add_watch(self.fd, encoded, self.WATCH_MASK)
+                if wd < 0:
+                    if ctypes.get_errno() == errno.ENOSPC:
+                        self.msg.warn(self.name, "Too many directories to watch; some changes could be missed.")
+                    continue
+                self.wds[wd] = path
+                self.paths[path] = wd
+
+        for path in [ path for path in self.paths if path not in directories ]:
+            wd = self.paths.pop(path)
+            del self.wds[wd]
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def _watch(self):
+        while self.running:
+            changed = set()
+            overflow = False
+
+            # Gather all events until things calm down
+            timeout = 1
+            while self.running:
+                (ready, _, _) = select.select([self.fd], [], [], timeout)
+                if not ready:
+                    break
+
+                for (wd, mask) in self._read_events():
+                    if mask & self.IN_Q_OVERFLOW:
+                        overflow = True
+                    elif wd in self.wds:
+                        changed.add(self.wds[wd])
+                timeout = self.settle_time
+
+            if overflow:
+                self.msg.debug(self.name, "Too many changes; refreshing the whole library.")
+                self.library.refresh()
+            else:
+                for path in changed:
+                    # The parent will notice if the directory itself is gone
+                    if os.path.isdir(path):
+                        self.library.refresh(path)
+                    elif os.path.dirname(path) in self.paths:
+                        self.library.refresh(os.path.dirname(path))
+
+            if changed or overflow:
+                self._sync_watches()
+
+    def _read_events(self):
+        try:
+            buf = os.read(self.fd, 65536)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return
+            raise
+
+        offset = 0
+        while offset + self.EVENT.size <= len(buf):
+            (wd, mask, cookie, length) = self.EVENT.unpack_from(buf, offset)
+            offset += self.EVENT.size + length
+            yield (wd, mask)
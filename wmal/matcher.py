@@ -0,0 +1,186 @@
+# This file is part of wMAL.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import difflib
+import heapq
+import re
+import threading
+
+class TitleMatcher(object):
+    """
+    Finds the title most similar to a given one among many, without
+    comparing it against every single title.
+
+    Titles are indexed by their trigrams; a lookup only considers the
+    titles sharing trigrams with the requested one, and computes the
+    exact :class:`difflib.SequenceMatcher` ratio for the **top_k** of
+    them with the most trigrams in common. The rest, including the ones
+    without any trigram in common, are only compared if the cheap upper
+    bounds of their ratio show they could still win, so the results are
+    the same as comparing against every title.
+
+    Every key (usually a show ID) can have many titles, like aliases.
+    """
+    def __init__(self, threshold=0.7, top_k=10):
+        self.threshold = threshold
+        self.top_k = top_k
+        self.lock = threading.RLock()
+
+        # key -> list of (entry, normalized title)
+        # entry -> (key, normalized title, trigrams)
+        # trigram -> set of entries
+        self.keys = dict()
+        self.entries = dict()
+        self.grams = dict()
+        self.next_entry = 0
+
+    def normalize(self, title):
+        """Returns the form of **title** that's compared."""
+        return title.lower()
+
+    def trigrams(self, title):
+        """Returns the set of trigrams of **title**, ignoring punctuation."""
+        title = ' %s ' % ' '.join(re.findall(r'\w+', title, re.UNICODE))
+        return set(title[i:i+3] for i in range(len(title) - 2))
+
+    def add(self, key, titles):
+        """Indexes **titles** under **key**, replacing the ones it had."""
+        with self.lock:
+            self.remove(key)
+
+            entries = []
+            for title in titles:
+                normalized = self.normalize(title)
+                grams = self.trigrams(normalized)
+
+                entry = self.next_entry
+                self.next_entry += 1
+                self.entries[entry] = (key, normalized, grams)
+                for gram in grams:
+                    self.grams.setdefault(gram, set()).add(entry)
+                entries.append(entry)
+
+            self.keys[key] = entries
+
+    def remove(self, key):
+        """Forgets the titles of **key**."""
+        with self.lock:
+            for entry in self.keys.pop(key, []):
+                (key, normalized, grams) = self.entries.pop(entry)
+                for gram in grams:
+                    self.grams[gram].discard(entry)
+                    if not self.grams[gram]:
+                        del self.grams[gram]
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+            self.entries.clear()
+            self.grams.clear()
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def candidates(self, title, best_only=False):
+        """
+        Returns a list of (key, ratio) tuples of the keys with a title
+        more similar to **title** than the threshold, best first.
+
+        If **best_only** is set, only the first one is guaranteed to be right,
+        which allows skipping many more comparisons.
+        """
+        normalized = self.normalize(title)
+        grams = self.trigrams(normalized)
+
+        with self.lock:
+            # Count the trigrams every indexed title has in common
+            shared = dict()
+            for gram in grams:
+                for entry in self.grams.get(gram, ()):
+                    shared[entry] = shared.get(entry, 0) + 1
+
+            def dice(entry):
+                return 2.0 * shared[entry] / (len(grams) + len(self.entries[entry][2]))
+
+            # The most promising ones get the exact comparison right away
+            top = heapq.nlargest(self.top_k, shared, key=dice)
+            scored = dict()
+            matcher = difflib.SequenceMatcher()
+            matcher.set_seq1(normalized)
+            for entry in sorted(top):
+                (key, candidate, candidate_grams) = self.entries[entry]
+                matcher.set_seq2(candidate)
+                ratio = matcher.ratio()
+                if ratio > self.threshold and ratio > scored.get(key, (0, 0))[0]:
+                    scored[key] = (ratio, entry)
+
+            # The rest only if their cheap upper bounds show they could
+            # still make it (or beat the best one)
+            bound = [self.threshold]
+            if best_only:
+                bound[0] = max(bound + [ ratio for (ratio, entry) in scored.itervalues() ])
+
+            # The query stays as the second sequence here, so only
+            # the candidate has to be counted for every quick_ratio
+            quick = difflib.SequenceMatcher()
+            quick.set_seq2(normalized)
+
+            def check(entry):
+                (key, candidate, candidate_grams) = self.entries[entry]
+                length = len(normalized) + len(candidate)
+                if 2.0 * min(len(normalized), len(candidate)) / length < bound[0]:
+                    return
+
+                quick.set_seq1(candidate)
+                if quick.quick_ratio() < bound[0]:
+                    return
+
+                matcher.set_seq2(candidate)
+                ratio = matcher.ratio()
+                if ratio > self.threshold and ratio > scored.get(key, (0, 0))[0]:
+                    scored[key] = (ratio, entry)
+                    if best_only:
+                        bound[0] = max(bound[0], ratio)
+
+            top = set(top)
+            for entry in sorted(shared):
+                if entry not in top:
+                    check(entry)
+
+            # Titles without a single trigram in common can still
+            # be similar enough character by character
+            for entry in self.entries:
+                if entry not in shared:
+                    check(entry)
+
+        # Earlier entries win ties, like a linear search would do
+        results = sorted(scored.iteritems(), key=lambda (key, (ratio, entry)): (-ratio, entry))
+        return [ (key, ratio) for (key, (ratio, entry)) in results ]
+
+    def match(self, title):
+        """
+        Returns a (key, ratio) tuple with the key that has the title most
+        similar to **title**, or (None, 0) if none is more similar than the
+        threshold.
+        """
+        results = self.candidates(title, True)
+        if results:
+            return results[0]
+        else:
+            return (None, 0)
@@ -0,0 +1,616 @@
+# This file is part of wMAL.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import cPickle
+import os
+import sqlite3
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+import utils
+
+class Storage(object):
+    """
+    Base interface for Data Handler storage engines.
+
+    A storage engine keeps the list cache, the info database and
+    the metadata of a single account and mediatype on disk (the queue
+    is kept apart in a :class:`QueueJournal`). The Data Handler holds
+    everything in memory and only tells the engine what has to be
+    persisted.
+
+    messenger: Messenger object to send useful messages to
+    userfolder: Name of the account folder inside the wMAL directory
+    mediatype: Mediatype of the list being stored
+    """
+    name = 'Storage'
+    msg = None
+
+    def __init__(self, messenger, userfolder, mediatype):
+        self.msg = messenger
+        self.userfolder = userfolder
+        self.mediatype = mediatype
+
+    def set_message_handler(self, message_handler):
+        self.msg = message_handler
+
+    def open(self):
+        """Prepares the storage for use; called when the Data Handler starts."""
+        pass
+
+    def close(self):
+        """Releases the storage; called when the Data Handler unloads."""
+        pass
+
+    def cache_exists(self):
+        raise NotImplementedError
+
+    def load_cache(self):
+        """Returns the whole show list as a dictionary keyed by show ID."""
+        raise NotImplementedError
+
+    def save_cache(self, showlist):
+        """Replaces the whole stored show list with **showlist**."""
+        raise NotImplementedError
+
+    def update_cache(self, shows, deleted):
+        """
+        Stores the added or changed **shows** and removes the
+        shows with the IDs in **deleted** from the stored list.
+        """
+        raise NotImplementedError
+
+    def get_info(self, showids):
+        """
+        Returns a dictionary with the stored detailed information of
+        the shows in **showids**. Shows without information are left out.
+        """
+        raise NotImplementedError
+
+    def update_info(self, shows):
+        """Stores the detailed information of the given **shows** only."""
+        raise NotImplementedError
+
+    def meta_exists(self):
+        raise NotImplementedError
+
+    def load_meta(self):
+        raise NotImplementedError
+
+    def save_meta(self, meta):
+        raise NotImplementedError
+
+class PickleStorage(Storage):
+    """
+    Legacy storage engine which keeps every section in its
+    own pickle file and rewrites the whole file on every change.
+
+    The info database is split into **info_shards** files by a hash
+    of the show ID, so reading or changing the information of a show
+    only touches a small part of it.
+    """
+    name = 'PickleStorage'
+
+    showlist = None
+    info_shards = 64
+
+    def __init__(self, messenger, userfolder, mediatype):
+        super(PickleStorage, self).__init__(messenger, userfolder, mediatype)
+
+        self.info_dir = utils.get_filename(userfolder, '%s.info.d' % mediatype)
+        # Whole info database pickle written by older versions
+        self.info_file = utils.get_filename(userfolder,  '%s.info' % mediatype)
+        self.cache_file = utils.get_filename(userfolder, '%s.list' % mediatype)
+        self.meta_file = utils.get_filename(userfolder, '%s.meta' % mediatype)
+
+    def cache_exists(self):
+        return os.path.isfile(self.cache_file)
+
+    def load_cache(self):
+        self.showlist = cPickle.load( open( self.cache_file , "rb" ) )
+        return self.showlist
+
+    def save_cache(self, showlist):
+        self.showlist = showlist
+        cPickle.dump(self.showlist, open( self.cache_file , "wb" ) )
+
+    def update_cache(self, shows, deleted):
+        # There's no way to write single shows into a pickle,
+        # so we have to dump the whole list we know of.
+        for show in shows:
+            self.showlist[show['id']] = show
+        for showid in deleted:
+            self.showlist.pop(showid, None)
+        self.save_cache(self.showlist)
+
+    def open(self):
+        if not os.path.isdir(self.info_dir) and os.path.isfile(self.info_file):
+            self.msg.info(self.name, "Splitting old info DB...")
+            self.update_info(self.iter_info())
+
+    def get_info(self, showids):
+        shards = dict()
+        for showid in showids:
+            shards.setdefault(self._shard(showid), []).append(showid)
+
+        infos = dict()
+        for shard, ids in shards.iteritems():
+            infocache = self._load_shard(shard)
+            for showid in ids:
+                if showid in infocache:
+                    infos[showid] = infocache[showid]
+        return infos
+
+    def update_info(self, shows):
+        shards = dict()
+        for show in shows:
+            shards.setdefault(self._shard(show['id']), []).append(show)
+
+        if not os.path.isdir(self.info_dir):
+            os.mkdir(self.info_dir)
+
+        for shard, infos in shards.iteritems():
+            infocache = self._load_shard(shard)
+            for info in infos:
+                infocache[info['id']] = info
+            self._save_shard(shard, infocache)
+
+    def iter_info(self):
+        """Yields every stored info entry; used to migrate them elsewhere."""
+        if os.path.isdir(self.info_dir):
+            for shard in xrange(self.info_shards):
+                for info in self._load_shard(shard).itervalues():
+                    yield info
+        elif os.path.isfile(self.info_file):
+            for info in cPickle.load( open( self.info_file , "rb" ) ).itervalues():
+                yield info
+
+    def info_exists(self):
+        return os.path.isdir(self.info_dir) or os.path.isfile(self.info_file)
+
+    def _shard(self, showid):
+        # crc32 gives the same shard for an ID on every run, unlike hash()
+        return (zlib.crc32(repr(showid)) & 0xffffffff) % self.info_shards
+
+    def _shard_file(self, shard):
+        return os.path.join(self.info_dir, '%02x' % shard)
+
+    def _load_shard(self, shard):
+        try:
+            return cPickle.load( open( self._shard_file(shard) , "rb" ) )
+        except IOError:
+            return dict()
+
+    def _save_shard(self, shard, infocache):
+        # Write to a temporary file first so a crash can't leave a broken shard
+        filename = self._shard_file(shard)
+        with open(filename + '.tmp', 'wb') as f:
+            cPickle.dump(infocache, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(filename + '.tmp', filename)
+
+    def meta_exists(self):
+        return os.path.isfile(self.meta_file)
+
+    def load_meta(self):
+        return cPickle.load( open( self.meta_file , "rb" ) )
+
+    def save_meta(self, meta):
+        cPickle.dump(meta, open( self.meta_file , "wb" ) )
+
+class SQLiteStorage(Storage):
+    """
+    Storage engine backed by a SQLite database.
+
+    Every show, info entry and metadata key is kept in its own row
+    as a pickled blob, so changing a single show only costs a single
+    row write. The first time it's opened it imports any cache
+    left by the :class:`PickleStorage` engine.
+    """
+    name = 'SQLiteStorage'
+
+    db = None
+
+    def __init__(self, messenger, userfolder, mediatype):
+        super(SQLiteStorage, self).__init__(messenger, userfolder, mediatype)
+
+        self.db_file = utils.get_filename(userfolder, '%s.db' % mediatype)
+        self.lock = threading.RLock()
+
+    def open(self):
+        migrate = not os.path.isfile(self.db_file)
+
+        # The Data Handler may persist from the autosend timer thread,
+        # so we allow the connection to be shared and serialize it ourselves.
+        self.db = sqlite3.connect(self.db_file, check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS shows (id PRIMARY KEY, data BLOB)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS info (id PRIMARY KEY, data BLOB)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, data BLOB)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS sections (name TEXT PRIMARY KEY)")
+
+        if migrate:
+            self._migrate()
+
+    def close(self):
+        if self.db:
+            with self.lock:
+                self.db.close()
+                self.db = None
+
+    def _migrate(self):
+        """Imports the cache files written by the pickle storage engine"""
+        old = PickleStorage(self.msg, self.userfolder, self.mediatype)
+        if not (old.cache_exists() or old.info_exists() or old.meta_exists()):
+            return
+
+        self.msg.info(self.name, "Migrating old cache files...")
+        if old.cache_exists():
+            self.save_cache(old.load_cache())
+        if old.info_exists():
+            self.update_info(old.iter_info())
+        if old.meta_exists():
+            self.save_meta(old.load_meta())
+
+    def _dumps(self, obj):
+        return sqlite3.Binary(cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL))
+
+    def _loads(self, blob):
+        return cPickle.loads(str(blob))
+
+    def _section_exists(self, name):
+        with self.lock:
+            cur = self.db.execute("SELECT 1 FROM sections WHERE name = ?", (name,))
+            return cur.fetchone() is not None
+
+    def _mark_section(self, name):
+        self.db.execute("INSERT OR IGNORE INTO sections (name) VALUES (?)", (name,))
+
+    def cache_exists(self):
+        return self._section_exists('shows')
+
+    def load_cache(self):
+        with self.lock:
+            showlist = dict()
+            for (data,) in self.db.execute("SELECT data FROM shows"):
+                show = self._loads(data)
+                showlist[show['id']] = show
+            return showlist
+
+    def save_cache(self, showlist):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM shows")
+            self.db.executemany("INSERT INTO shows (id, data) VALUES (?, ?)",
+                ((showid, self._dumps(show)) for showid, show in showlist.iteritems()))
+            self._mark_section('shows')
+
+    def update_cache(self, shows, deleted):
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO shows (id, data) VALUES (?, ?)",
+                ((show['id'], self._dumps(show)) for show in shows))
+            self.db.executemany("DELETE FROM shows WHERE id = ?",
+                ((showid,) for showid in deleted))
+            self._mark_section('shows')
+
+    def get_info(self, showids):
+        showids = list(showids)
+        infos = dict()
+        with self.lock:
+            # Stay below the limit of variables per statement
+            for start in xrange(0, len(showids), 500):
+                chunk = showids[start:start+500]
+                query = "SELECT data FROM info WHERE id IN (%s)" % ','.join('?' * len(chunk))
+                for (data,) in self.db.execute(query, chunk):
+                    info = self._loads(data)
+                    infos[info['id']] = info
+        return infos
+
+    def update_info(self, shows):
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO info (id, data) VALUES (?, ?)",
+                ((show['id'], self._dumps(show)) for show in shows))
+
+    def meta_exists(self):
+        return self._section_exists('meta')
+
+    def load_meta(self):
+        with self.lock:
+            return dict( (key, self._loads(data)) for (key, data) in self.db.execute("SELECT key, data FROM meta") )
+
+    def save_meta(self, meta):
+        with self.lock, self.db:
+            # Replace the whole table, so keys dropped from meta go away too
+            self.db.execute("DELETE FROM meta")
+            self.db.executemany("INSERT INTO meta (key, data) VALUES (?, ?)",
+                ((key, self._dumps(value)) for key, value in meta.iteritems()))
+            self._mark_section('meta')
+
+class QueueJournal(object):
+    """
+    Append-only journal of the update queue.
+
+    Instead of rewriting the whole queue after every change, each queue
+    operation is appended to the journal file and synced to disk, so
+    a crash can lose at most the operation being written. The queue
+    is rebuilt by replaying the journal, which gets compacted in the
+    background once it grows past **compact_threshold** records.
+
+    Supported operations:
+      ('add', item), ('delete', item): Append the queue item
+      ('update', showid, title, changes): Merge the changed keys into
+        the queued add or update of the show, or queue a new update
+      ('send', keys): Take the items with the (showid, action) **keys**
+        out of the queue while they're being sent; later updates of
+        those shows go to new items
+      ('remove', showid, action): Drop the item being sent
+      ('requeue', showid, action): Put the item being sent back at the
+        end, merging into it any update of the show queued meanwhile
+      ('unsend',): Put every item still being sent back at the front
+      ('item', item): Append the item verbatim (used by compaction)
+      ('clear',): Empty the queue
+
+    messenger: Messenger object to send useful messages to
+    userfolder: Name of the account folder inside the wMAL directory
+    mediatype: Mediatype of the queue being stored
+    """
+    name = 'QueueJournal'
+    msg = None
+
+    compact_threshold = 200
+
+    def __init__(self, messenger, userfolder, mediatype):
+        self.msg = messenger
+        self.journal_file = utils.get_filename(userfolder, '%s.queue.journal' % mediatype)
+        # Whole queue pickle written by older versions
+        self.legacy_file = utils.get_filename(userfolder, '%s.queue' % mediatype)
+
+        self.lock = threading.RLock()
+        self.fd = None
+        self.size = 0
+        self.records = 0
+        self.compact_thread = None
+
+    def set_message_handler(self, message_handler):
+        self.msg = message_handler
+
+    def exists(self):
+        return os.path.isfile(self.journal_file) or os.path.isfile(self.legacy_file)
+
+    def load(self):
+        """Rebuilds the queue by replaying the journal and returns it."""
+        with self.lock:
+            interrupted = False
+            if os.path.isfile(self.journal_file):
+                (ops, self.size) = self._read()
+                (queue, sending) = self._replay(ops)
+                self.records = len(ops)
+
+                # Cut off a record left half-written by a crash
+                if self.size != os.path.getsize(self.journal_file):
+                    self.msg.warn(self.name, "Discarding incomplete queue operation.")
+                    with open(self.journal_file, 'r+b') as f:
+                        f.truncate(self.size)
+
+                # Items whose sending was interrupted go back to the queue
+                interrupted = bool(sending)
+                queue = self._unsend(queue, sending).values()
+            elif os.path.isfile(self.legacy_file):
+                self.msg.info(self.name, "Migrating old queue file...")
+                queue = cPickle.load( open( self.legacy_file , "rb" ) )
+                self._write_snapshot(self.journal_file, [ ('item', item) for item in queue ])
+                self.size = os.path.getsize(self.journal_file)
+                self.records = len(queue)
+            else:
+                queue = []
+
+            self._open()
+            if interrupted:
+                self.append(('unsend',))
+
+        if self.records > self.compact_threshold:
+            self.compact(queue)
+
+        return queue
+
+    def close(self):
+        """Waits for any running compaction and closes the journal."""
+        if self.compact_thread:
+            self.compact_thread.join()
+
+        with self.lock:
+            if self.fd:
+                self.fd.close()
+                self.fd = None
+
+    def append(self, op):
+        """Appends the queue operation **op** and syncs it to disk."""
+        with self.lock:
+            if not self.fd:
+                self._open()
+
+            record = self._pack(op)
+            self.fd.write(record)
+            self.fd.flush()
+            os.fsync(self.fd.fileno())
+            self.size += len(record)
+            self.records += 1
+
+    def needs_compaction(self):
+        return self.records > self.compact_threshold
+
+    def compact(self, queue, sending=()):
+        """
+        Starts rewriting the journal as a snapshot of **queue** and the
+        items being **sent** in a background thread.
+
+        They must be the result of replaying every operation appended
+        so far; they're copied before returning.
+        """
+        with self.lock:
+            if self.compact_thread and self.compact_thread.is_alive():
+                return
+
+            snapshot = [ ('item', dict(item)) for item in sending ]
+            if snapshot:
+                snapshot.append(('send', [ (item['id'], item['action']) for item in sending ]))
+            snapshot += [ ('item', dict(item)) for item in queue ]
+            offset = self.size
+            records = self.records
+
+            self.compact_thread = threading.Thread(target=self._compact, args=(snapshot, offset, records))
+            self.compact_thread.daemon = True
+            self.compact_thread.start()
+
+    def _compact(self, snapshot, offset, records):
+        self.msg.debug(self.name, "Compacting queue journal...")
+        tmp_file = self.journal_file + '.tmp'
+
+        try:
+            self._write_snapshot(tmp_file, snapshot)
+
+            with self.lock:
+                # Carry over the operations appended while we were
+                # writing the snapshot, then swap the files atomically
+                with open(self.journal_file, 'rb') as f:
+                    f.seek(offset)
+                    tail = f.read()
+                with open(tmp_file, 'ab') as f:
+                    f.write(tail)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                if self.fd:
+                    self.fd.close()
+                os.rename(tmp_file, self.journal_file)
+
+                self.size = os.path.getsize(self.journal_file)
+                self.records = len(snapshot) + self.records - records
+                self._open()
+        except (IOError, OSError), e:
+            self.msg.warn(self.name, "Couldn't compact queue journal: %s" % e)
+
+    @classmethod
+    def replay(cls, ops):
+        """Applies the list of queue operations **ops** and returns the resulting queue."""
+        (queue, sending) = cls._replay(ops)
+        return cls._unsend(queue, sending).values()
+
+    @classmethod
+    def _replay(cls, ops):
+        # Queue items are unique per show and action, so we can keep
+        # them keyed that way while preserving their order
+        queue = OrderedDict()
+        sending = OrderedDict()
+        for op in ops:
+            kind = op[0]
+            if kind in ('add', 'delete', 'item'):
+                item = dict(op[1])
+                queue[(item['id'], item['action'])] = item
+            elif kind == 'update':
+                (showid, title, changes) = op[1:]
+                q = queue.get((showid, 'add')) or queue.get((showid, 'update'))
+                if q:
+                    q.update(changes)
+                else:
+                    item = {'id': showid, 'action': 'update', 'title': title}
+                    item.update(changes)
+                    queue[(showid, 'update')] = item
+            elif kind == 'send':
+                for key in op[1]:
+                    key = tuple(key)
+                    if key in queue:
+                        sending[key] = queue.pop(key)
+            elif kind in ('remove', 'requeue'):
+                # Journals written before 'send' existed act on the queue
+                item = sending.pop(op[1:], None) or queue.pop(op[1:], None)
+                if item and kind == 'requeue':
+                    cls._requeue(queue, item)
+            elif kind == 'unsend':
+                queue = cls._unsend(queue, sending)
+                sending = OrderedDict()
+            elif kind == 'clear':
+                queue.clear()
+                sending.clear()
+        return (queue, sending)
+
+    @classmethod
+    def _requeue(cls, queue, item):
+        """Appends **item** back to **queue**, taking over the update of its show queued meanwhile."""
+        if item['action'] in ('add', 'update'):
+            newer = queue.pop((item['id'], 'update'), None)
+            if newer:
+                cls.merge(item, newer)
+        queue[(item['id'], item['action'])] = item
+
+    @classmethod
+    def _unsend(cls, queue, sending):
+        """Returns a queue with the items of **sending** in front of the ones in **queue**."""
+        result = OrderedDict(sending)
+        for key, item in queue.iteritems():
+            older = result.get((item['id'], 'add')) or result.get((item['id'], 'update'))
+            if item['action'] == 'update' and older:
+                cls.merge(older, item)
+            else:
+                result[key] = item
+        return result
+
+    @staticmethod
+    def merge(item, newer):
+        """Applies to queue **item** the changes of the **newer** update of the same show."""
+        for key, value in newer.iteritems():
+            if key != 'action':
+                item[key] = value
+
+    def _open(self):
+        self.fd = open(self.journal_file, 'ab')
+
+    def _pack(self, op):
+        data = cPickle.dumps(op, cPickle.HIGHEST_PROTOCOL)
+        return struct.pack('!I', len(data)) + data
+
+    def _read(self):
+        """Returns the complete operations in the journal and the size they take."""
+        ops = []
+        size = 0
+        with open(self.journal_file, 'rb') as f:
+            while True:
+                header = f.read(4)
+                if len(header) < 4:
+                    break
+                (length,) = struct.unpack('!I', header)
+                data = f.read(length)
+                if len(data) < length:
+                    break
+                try:
+                    ops.append(cPickle.loads(data))
+                except Exception:
+                    break
+                size += 4 + length
+        return (ops, size)
+
+    def _write_snapshot(self, filename, ops):
+        with open(filename, 'wb') as f:
+            for op in ops:
+                f.write(self._pack(op))
+            f.flush()
+            os.fsync(f.fileno())
+
+# Put the available storage engines here
+engines = {
+    'pickle': PickleStorage,
+    'sqlite': SQLiteStorage,
+}
@@ -14,17 +14,54 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import collections
+import json
+import socket
 import subprocess
 import threading
 import re
 import time
 import os
 from decimal import Decimal
-import difflib
 
+import matcher
 import messenger
 import utils
 
+# The patterns used by AnimeInfoExtractor, compiled only once
+_extension_re = re.compile("\.(\w{3})$")
+_dot_re = re.compile('([^.])\.([^.])')
+_hyphen_re = re.compile('([^\-])-([^\-])')
+_resolution_re = re.compile('(?:[^0-9a-zA-Z])(\d{3,4}(?:p|i|x\d{3,4}))(?:[^0-9a-zA-Z]|$)')
+_hdsd_re = re.compile('(?:\[|\(|\d)(HD|SD)(?:\]|\)| |\.)')
+_hdsd_episode_re = re.compile('(?:\d{1,3})(HD|SD)(?:[^a-zA-Z])')
+_hash_re = re.compile('(?:\[|\()((?:[A-F]|[a-f]|\d){8})(?:\]|\))')
+_remux_re = re.compile('(?:[\(\[][^\)\]]*?[^0-9a-zA-Z\)\]]?)(Remux)(?:[^0-9a-zA-Z]|$)', re.IGNORECASE)
+_nosubber_round_re = re.compile('\((?:[^\)]*?)###NO#SUBBER#HERE##(?:.*?)\)')
+_nosubber_square_re = re.compile('\[(?:[^\]]*?)###NO#SUBBER#HERE##(?:.*?)\]')
+_empty_brackets_re = re.compile('(?:\[(?:[^0-9a-zA-Z]*?)\])|(?:\((?:[^0-9a-zA-Z]*?)\))')
+_square_re = re.compile('\[([^\. ].*?)\]')
+_round_re = re.compile('\(([^\. ].*?)\)')
+_curly_re = re.compile('{([^\. ].*?)}')
+_version_re = re.compile('(?:[^a-zA-Z])v([0-7])(?:[^0-9a-zA-Z]|$)', re.IGNORECASE)
+_volume_re = re.compile('[^0-9a-zA-Z](?:vol(?:ume)?\.? ?)(\d{1,3})(?: ?- ?(?:vol(?:ume)?\.? ?)?(\d{1,3}))?(?:[^0-9a-zA-Z]|$)', re.IGNORECASE)
+_pv_re = re.compile(' PV ?(\d)?(?:[^a-zA-Z0-9]|$)')
+_concurrent_episodes_re = re.compile('[^0-9a-zA-Z](?:E\.?|Ep(?:i|isode)?s?(?: |\.)?)?(\d{1,4})\+(\d{1,4})(?:[^0-9a-zA-Z]|$)', re.IGNORECASE)
+_multiple_episodes_re = re.compile('[^0-9a-zA-Z](?:E\.?|Ep(?:i|isode)?(?: |\.)?)?((?:\d{1,3}|1[0-8]\d{2})(?:\.\d{1})?)-(\d{1,4}(?:\.\d{1})?)(?:[^0-9a-zA-Z]|$)', re.IGNORECASE)
+_multiple_episodes_pack_re = re.compile('[^0-9a-zA-Z](?:E\.?|Ep(?:i|isode)?(?: |\.)?)?((?:\d{1,3}|1[0-8]\d{2})(?:\.\d{1})?) ?- ?(\d{1,4}(?:\.\d{1})?)(?:[^0-9a-zA-Z]|$)', re.IGNORECASE)
+_episode_specifier_re = re.compile('(?:[^0-9a-zA-Z])(E\.?|Ep(?:i|isode)?(?: |\.)?)(\d{1,}(?:\.\d{1})?)(?:[^\d]|$)', re.IGNORECASE)
+_lonely_number_re = re.compile('(?:.*)(?:[^0-9a-zA-Z\.])((?:\d{1,3}|1[0-8]\d{2})(?:\.\d{1})?)(?:[^0-9a-zA-Z]|$)')
+_lonely_number_brackets_re = re.compile('(?:.*)(?:[^0-9a-zA-Z\.\[\(])((?:\d{1,3}|1[0-8]\d{2})(?:\.\d{1})?)(?:[^0-9a-zA-Z\]\)]|$)')
+_any_brackets_re = re.compile('(?:\[.*?\])|(?:\(.*?\))')
+_double_space_re = re.compile('  (?:.*)')
+_unclosed_bracket_re = re.compile('(.*)(?:[\(\[({].*)$')
+
+_special_tags = [ (k, tag, re.compile('(?:[\(\[](?:|[^\)\]]*?[^0-9a-zA-Z\)\]]))(' + tag + ')(?:[^0-9a-zA-Z]|$)', re.IGNORECASE))
+                  for k, v in {'video': ['H264', 'H.264', 'x264', 'XviD', 'DivX', 'MP4'],
+                               'audio': ['AC3', 'AAC', 'MP3', 'FLAC'],
+                               'source': ['TV', 'DVD', 'BluRay', 'BD', 'Blu-Ray', 'BDMV']}.iteritems()
+                  for tag in v ]
+
 class AnimeInfoExtractor(object):
     """
     Extracts lots of information about anime from filename alone
@@ -64,7 +101,7 @@ class AnimeInfoExtractor(object):
         return int(ep)
 
     def __extractExtension(self, filename):
-        m = re.search("\.(\w{3})$", filename)
+        m = _extension_re.search(filename)
         if m:
             self.extension = m.group(1)
             filename = filename[:-4]
@@ -73,31 +110,27 @@ class AnimeInfoExtractor(object):
     def __cleanUpSpaces(self, filename):
         filename = filename.replace('_', ' ')
         if not ' ' in filename:
-            filename = re.sub('([^.])\.([^.])', r'\1 \2', filename)
+            filename = _dot_re.sub(r'\1 \2', filename)
             # to handle .-. case (where - is any single chara)
-            filename = re.sub('([^.])\.([^.])', r'\1 \2', filename)
+            filename = _dot_re.sub(r'\1 \2', filename)
             # If there are still no spaces try replacing hyphens with spaces
             if not ' ' in filename:
-                filename = re.sub('([^\-])-([^\-])', r'\1 \2', filename)
+                filename = _hyphen_re.sub(r'\1 \2', filename)
                 # to handle -.- case (where . is any single chara)
-                filename = re.sub('([^\-])-([^\-])', r'\1 \2', filename)
+                filename = _hyphen_re.sub(r'\1 \2', filename)
         return filename
 
     def __extractSpecialTags(self, filename):
-        tags = {'video': ['H264', 'H.264', 'x264', 'XviD', 'DivX', 'MP4'],
-            'audio': ['AC3', 'AAC', 'MP3', 'FLAC'],
-            'source': ['TV', 'DVD', 'BluRay', 'BD', 'Blu-Ray', 'BDMV']}
-        for k, v in tags.iteritems():
-            for tag in v:
-                m = re.search('(?:[\(\[](?:|[^\)\]]*?[^0-9a-zA-Z\)\]]))(' + tag + ')(?:[^0-9a-zA-Z]|$)', filename, flags=re.IGNORECASE)
-                if m:
-                    if (k == 'video'):
-                        self.videoType.append(tag)
-                    elif (k == 'audio'):
-                        self.audioType.append(tag)
-                    elif (k == 'source'):
-                        self.releaseSource.append(tag)
-                    filename = filename[:m.start(1)] + '###NO#SUBBER#HERE###' + filename[m.end(1):]  # remove the match
+        for (k, tag, tag_re) in _special_tags:
+            m = tag_re.search(filename)
+            if m:
+                if (k == 'video'):
+                    self.videoType.append(tag)
+                elif (k == 'audio'):
+                    self.audioType.append(tag)
+                elif (k == 'source'):
+                    self.releaseSource.append(tag)
+                filename = filename[:m.start(1)] + '###NO#SUBBER#HERE###' + filename[m.end(1):]  # remove the match
         return filename
 
     def __extractVideoProfile(self, filename):
@@ -121,17 +154,17 @@ class AnimeInfoExtractor(object):
 
     def __extractResolution(self, filename):
         # Match 3 or 4 chars followed by p, i, or x and 3 or 4 more chars, surrounded by any non-alphanumberic chars
-        m = re.search('(?:[^0-9a-zA-Z])(\d{3,4}(?:p|i|x\d{3,4}))(?:[^0-9a-zA-Z]|$)', filename)
+        m = _resolution_re.search(filename)
         if m:
             self.resolution = m.group(1)
             filename = filename[:m.start(1)] + filename[m.end(1):]
         else:
-            m = re.search('(?:\[|\(|\d)(HD|SD)(?:\]|\)| |\.)', filename)
+            m = _hdsd_re.search(filename)
             if m:
                 self.resolution = m.group(1)
                 filename = filename[:m.start(1)] + filename[m.end(1):]
             else:
-                m = re.search('(?:\d{1,3})(HD|SD)(?:[^a-zA-Z])', filename)
+                m = _hdsd_episode_re.search(filename)
                 if m:
                     self.resolution = m.group(1)
                     filename = filename[:m.start(1)] + filename[m.end(1):]  # Super special case for HD/SD imediately after episode
@@ -139,37 +172,37 @@ class AnimeInfoExtractor(object):
 
     def __extractHash(self, filename):
         # Match anything in square or round brackets that is 8 hex digits
-        m = re.search('(?:\[|\()((?:[A-F]|[a-f]|\d){8})(?:\]|\))', filename)
+        m = _hash_re.search(filename)
         if m:
             self.hash = m.group(1)
             filename = filename[:m.start()] + filename[m.end():]
         return filename
 
     def __checkIfRemux(self, filename):
-        m = re.search('(?:[\(\[][^\)\]]*?[^0-9a-zA-Z\)\]]?)(Remux)(?:[^0-9a-zA-Z]|$)', filename, flags=re.IGNORECASE)
+        m = _remux_re.search(filename)
         return True if m else False
 
     def __cleanUpBrackets(self, filename):
         # Can get rid of the brackets that won't contain subber
-        filename = re.sub('\((?:[^\)]*?)###NO#SUBBER#HERE##(?:.*?)\)', '', filename)
-        filename = re.sub('\[(?:[^\]]*?)###NO#SUBBER#HERE##(?:.*?)\]', '', filename)
+        filename = _nosubber_round_re.sub('', filename)
+        filename = _nosubber_square_re.sub('', filename)
         # Strip any empty sets of brackets
-        filename = re.sub('(?:\[(?:[^0-9a-zA-Z]*?)\])|(?:\((?:[^0-9a-zA-Z]*?)\))', ' ', filename)
+        filename = _empty_brackets_re.sub(' ', filename)
         return filename
 
     def __extractSubber(self, filename, remux):
         # Extract the subber from square brackets (or round failing that)
-        m = re.search('\[([^\. ].*?)\]', filename)
+        m = _square_re.search(filename)
         if m:
             self.subberTag = m.group(1)
             filename = filename[:m.start()] + filename[m.end():]
         else:
-            m = re.search('\(([^\. ].*?)\)', filename)
+            m = _round_re.search(filename)
             if m:
                 self.subberTag = m.group(1)
                 filename = filename[:m.start()] + filename[m.end():]
             else:
-                m = re.search('{([^\. ].*?)}', filename)
+                m = _curly_re.search(filename)
                 if m:
                     self.subberTag = m.group(1)
                     filename = filename[:m.start()] + filename[m.end():]
@@ -177,7 +210,7 @@ class AnimeInfoExtractor(object):
         # Add the remux string if this was a remux and its not found in the subber tag
         if remux and not 'remux' in self.subberTag.lower():
             # refind remux and remove it
-            m = re.search('(?:[\(\[][^\)\]]*?[^0-9a-zA-Z\)\]]?)(Remux)(?:[^0-9a-zA-Z]|$)', filename, flags=re.IGNORECASE)
+            m = _remux_re.search(filename)
             if m:
                 filename = filename[:m.start(1)] + filename[m.end(1):]
             if self.subberTag:
@@ -188,7 +221,7 @@ class AnimeInfoExtractor(object):
 
     def __extractVersion(self, filename):
         # Extract the version number (limit at v7 since V8 is possible in a title...)
-        m = re.search('(?:[^a-zA-Z])v([0-7])(?:[^0-9a-zA-Z]|$)', filename, flags=re.IGNORECASE)
+        m = _version_re.search(filename)
         if m:
             self.version = int(m.group(1))
             filename = filename[:m.start(1) - 1] + filename[m.end(1):]
@@ -197,7 +230,7 @@ class AnimeInfoExtractor(object):
     def __extractVolumeIfPack(self, filename, title_len):
     # Check if this is a volume pack - only relevant for no extension
         if not self.extension:
-            m = re.search('[^0-9a-zA-Z](?:vol(?:ume)?\.? ?)(\d{1,3})(?: ?- ?(?:vol(?:ume)?\.? ?)?(\d{1,3}))?(?:[^0-9a-zA-Z]|$)', filename, flags=re.IGNORECASE)
+            m = _volume_re.search(filename)
             if m:
                 self.volumeStart = int(m.group(1))
                 if m.group(2):
@@ -208,7 +241,7 @@ class AnimeInfoExtractor(object):
 
     def __extractPv(self, filename):
         # Check if this is a PV release (not relevant if its a pack)
-        m = re.search(' PV ?(\d)?(?:[^a-zA-Z0-9]|$)', filename)
+        m = _pv_re.search(filename)
         if not self.volumeStart and m:
             self.pv = 0
             if m.group(1):
@@ -218,7 +251,7 @@ class AnimeInfoExtractor(object):
 
     def __extractEpisodeNumbers(self, filename):
         # First check for concurrent episodes (with a +)
-        m = re.search('[^0-9a-zA-Z](?:E\.?|Ep(?:i|isode)?s?(?: |\.)?)?(\d{1,4})\+(\d{1,4})(?:[^0-9a-zA-Z]|$)', filename, flags=re.IGNORECASE)
+        m = _concurrent_episodes_re.search(filename)
         if m:
             start = int(m.group(1))
             end = int(m.group(2))
@@ -230,30 +263,30 @@ class AnimeInfoExtractor(object):
             # Check for multiple episodes
             if self.extension:
                 # no spaces allowed around the hyphen
-                ep_search_string = '[^0-9a-zA-Z](?:E\.?|Ep(?:i|isode)?(?: |\.)?)?((?:\d{1,3}|1[0-8]\d{2})(?:\.\d{1})?)-(\d{1,4}(?:\.\d{1})?)(?:[^0-9a-zA-Z]|$)'
+                m = _multiple_episodes_re.search(filename)
             else:
-                ep_search_string = '[^0-9a-zA-Z](?:E\.?|Ep(?:i|isode)?(?: |\.)?)?((?:\d{1,3}|1[0-8]\d{2})(?:\.\d{1})?) ?- ?(\d{1,4}(?:\.\d{1})?)(?:[^0-9a-zA-Z]|$)'  # probably a pack... so allow spaces around the hyphen
-            m = re.search(ep_search_string, filename, flags=re.IGNORECASE)
+                # probably a pack... so allow spaces around the hyphen
+                m = _multiple_episodes_pack_re.search(filename)
             if m:
                 self.episodeStart = Decimal(m.group(1))
                 self.episodeEnd = Decimal(m.group(2))
                 filename = filename[:m.start() + 1]
         if not self.episodeStart:
             # Check if there is an episode specifier
-            m = re.search('(?:[^0-9a-zA-Z])(E\.?|Ep(?:i|isode)?(?: |\.)?)(\d{1,}(?:\.\d{1})?)(?:[^\d]|$)', filename, flags=re.IGNORECASE)
+            m = _episode_specifier_re.search(filename)
             if m:
                 self.episodeStart = Decimal(m.group(2))
                 filename = filename[:m.start() + 1]
         if not self.episodeStart:
             # Check any remaining lonely numbers as episode (towards the end has priority)
             # First try outside brackets
-            m = re.search('(?:.*)(?:[^0-9a-zA-Z\.])((?:\d{1,3}|1[0-8]\d{2})(?:\.\d{1})?)(?:[^0-9a-zA-Z]|$)', filename)
+            m = _lonely_number_re.search(filename)
             if m:
                 self.episodeStart = Decimal(m.group(1))
                 filename = filename[:m.start(1)]
         if not self.episodeStart:
             # then allow brackets
-            m = re.search('(?:.*)(?:[^0-9a-zA-Z\.\[\(])((?:\d{1,3}|1[0-8]\d{2})(?:\.\d{1})?)(?:[^0-9a-zA-Z\]\)]|$)', filename)
+            m = _lonely_number_brackets_re.search(filename)
             if m:
                 self.episodeStart = Decimal(m.group(1))
                 filename = filename[:m.start(1)]
@@ -263,26 +296,26 @@ class AnimeInfoExtractor(object):
         # Unfortunately its very hard to know if there should be brackets in the title...
         # We really should strip brackets... so to anything with brackets in the title: sorry =(
         # Strip anything thats still in brackets, but backup the first case incase it IS the title...
-        m = re.search('\[([^\. ].*?)\]', filename)
+        m = _square_re.search(filename)
         backup_title = ''
         if m:
             backup_title = m.group(1)
             filename = filename[:m.start()] + filename[m.end():]
         else:
-            m = re.search('\(([^\. ].*?)\)', filename)
+            m = _round_re.search(filename)
             if m:
                 backup_title = m.group(1)
                 filename = filename[:m.start()] + filename[m.end():]
             else:
-                m = re.search('{([^\. ].*?)}', filename)
+                m = _curly_re.search(filename)
                 if m:
                     backup_title = m.group(1)
                     filename = filename[:m.start()] + filename[m.end():]
-        filename = re.sub('(?:\[.*?\])|(?:\(.*?\))', ' ', filename)
+        filename = _any_brackets_re.sub(' ', filename)
         filename = filename.strip(' -')
-        filename = re.sub('  (?:.*)', '', filename)
+        filename = _double_space_re.sub('', filename)
         # Strip any unclosed brackets and anything after them
-        filename = re.sub('(.*)(?:[\(\[({].*)$', r'\1', filename)
+        filename = _unclosed_bracket_re.sub(r'\1', filename)
         self.name = filename.strip(' -')
         if self.name == '':
             self.name = backup_title
@@ -315,29 +348,216 @@ class AnimeInfoExtractor(object):
         filename = filename.rstrip('([{')
         self.__extractShowName(filename)
 
+_extractor_cache = utils.LRUCache(1000)
+
+def extract_info(filename):
+    """
+    Returns the :class:`AnimeInfoExtractor` of **filename**, reusing the one
+    from an earlier call if it's still cached, so it must not be modified.
+    """
+    aie = _extractor_cache.get(filename)
+    if aie is None:
+        aie = AnimeInfoExtractor(filename)
+        _extractor_cache[filename] = aie
+    return aie
+
+def extract_info_many(filenames):
+    """
+    Returns a list with the :class:`AnimeInfoExtractor` of every one
+    of **filenames**, analyzing repeated names only once.
+    """
+    extracted = dict()
+    for filename in filenames:
+        if filename not in extracted:
+            extracted[filename] = extract_info(filename)
+    return [ extracted[filename] for filename in filenames ]
+
+class PlayerDetector(object):
+    """
+    Finds the video file a running player has open by reading procfs
+    directly, instead of running lsof on every check.
+
+    Processes already known to be players aren't checked again, and only
+    the file descriptors of the ones matching **players** are looked at.
+    **extensions** is a regex of the video file extensions to look for,
+    and **proc_root** is where procfs is mounted.
+    """
+    def __init__(self, players, extensions='mkv|mp4|avi', proc_root='/proc'):
+        self.players = players
+        self.extensions = extensions
+        self.proc_root = proc_root
+        self._players_re = re.compile(players)
+        self._ext_re = re.compile(r'\.(?:%s)$' % extensions, re.I)
+
+        # PIDs known to be players
+        self.pids = set()
+
+    def available(self):
+        """Returns True if procfs can be used in this system."""
+        return os.path.isdir(os.path.join(self.proc_root, 'self', 'fd'))
+
+    def player_pids(self):
+        """Returns a sorted list with the PIDs of the running players."""
+        try:
+            running = set(int(name) for name in os.listdir(self.proc_root) if name.isdigit())
+        except OSError:
+            return []
+
+        # Forget the players that are gone, and check the other processes;
+        # those are checked every time since they can still exec into a
+        # player (like a launcher script or our own forked process)
+        self.pids &= running
+        for pid in running - self.pids:
+            if self._is_player(pid):
+                self.pids.add(pid)
+
+        return sorted(self.pids)
+
+    def playing_files(self, pids=None):
+        """
+        Returns a list with the names of every video file open by the
+        players, or by the ones with the given **pids**.
+        """
+        if pids is None:
+            pids = self.player_pids()
+
+        filenames = []
+        for pid in pids:
+            fddir = os.path.join(self.proc_root, str(pid), 'fd')
+            try:
+                fds = os.listdir(fddir)
+            except OSError:
+                # The process is gone or isn't ours
+                continue
+
+            for fd in sorted(fds, key=lambda fd: int(fd) if fd.isdigit() else fd):
+                try:
+                    path = os.readlink(os.path.join(fddir, fd))
+                except OSError:
+                    continue
+
+                if self._ext_re.search(path):
+                    filename = os.path.basename(path).decode('utf-8')
+                    if filename not in filenames:
+                        filenames.append(filename)
+
+        return filenames
+
+    def _is_player(self, pid):
+        try:
+            with open(os.path.join(self.proc_root, str(pid), 'comm')) as f:
+                comm = f.read().strip()
+        except IOError:
+            return False
+
+        return bool(self._players_re.search(comm))
+
+class MpvIPC(object):
+    """
+    Client for the JSON IPC socket of mpv (started with
+    ``--input-ipc-server=`` **path**), which lets the tracker hear
+    about the file being played and its position as they change.
+    """
+    properties = ['path', 'percent-pos']
+    """Properties to be notified of, as property-change events."""
+
+    def __init__(self, path):
+        self.path = path
+        self.s = None
+        self.buffer = ''
+
+    def connect(self):
+        """
+        Connects to the player and subscribes to its properties.
+        Raises :class:`socket.error` if the player isn't listening.
+        """
+        self.close()
+        self.s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.s.connect(self.path)
+            for i, name in enumerate(self.properties):
+                self.send(['observe_property', i + 1, name])
+        except socket.error:
+            self.close()
+            raise
+
+    def send(self, command):
+        self.s.sendall(json.dumps({'command': command}) + '\n')
+
+    def events(self):
+        """
+        Yields every event the player sends, as a dictionary, until it
+        closes the connection. Replies to commands are skipped.
+        """
+        while True:
+            while '\n' not in self.buffer:
+                data = self.s.recv(4096)
+                if not data:
+                    return
+                self.buffer += data
+
+            (line, self.buffer) = self.buffer.split('\n', 1)
+            if not line.strip():
+                continue
+
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+
+            if 'event' in message:
+                yield message
+
+    def close(self):
+        if self.s:
+            self.s.close()
+            self.s = None
+        self.buffer = ''
+
 class Tracker(object):
     msg = None
     active = True
-    list = None
+    index = None
+    detector = None
     last_show_tuple = None
-    last_filename = None
+    sessions = None
+    last_updated = False
+    player_running = False
+    ipc = None
     
     name = 'Tracker'
+    
+    min_interval = 1
+    """Shortest time in seconds between checks, even near an update."""
+    max_interval = 600
+    """Longest time in seconds between checks while no player is running."""
 
     signals = { 'playing' : None,
                 'update': None, }
 
-    def __init__(self, messenger, tracker_list, process_name, interval, update_wait):
+    def __init__(self, messenger, tracker_list, process_name, interval, update_wait, ipc_socket=None, update_percent=80):
         self.msg = messenger
         self.msg.info(self.name, 'Initializing...')
+        
+        self.condition = threading.Condition()
+        self.wakeup = False
+        self.polls = collections.deque()
+        self.sessions = dict()
     
-        self.list = tracker_list
+        self.update_list(tracker_list)
         #self.interval = interval
         #self.update_wait = update_wait
         self.process_name = process_name
+        self.detector = PlayerDetector(process_name)
+        self.update_percent = update_percent
         
-        tracker_args = (interval, update_wait)
-        tracker_t = threading.Thread(target=self._tracker, args=tracker_args)
+        if ipc_socket:
+            # The player tells us what it's doing, so there's no need to poll
+            self.ipc = MpvIPC(ipc_socket)
+            tracker_t = threading.Thread(target=self._ipc_tracker, args=(interval,))
+        else:
+            tracker_args = (interval, update_wait)
+            tracker_t = threading.Thread(target=self._tracker, args=tracker_args)
         tracker_t.daemon = True
         self.msg.debug(self.name, 'Enabling tracker...')
         tracker_t.start()
@@ -351,9 +571,43 @@ class Tracker(object):
     
     def enable(self):
         self.active = True
+        self._wake()
+    
+    def polls_per_hour(self):
+        """Returns how many times the player was checked in the last hour."""
+        with self.condition:
+            self._prune_polls(time.time())
+            return len(self.polls)
     
     def update_list(self, tracker_list):
-        self.list = tracker_list
+        """Replaces the whole list of shows the tracker looks for."""
+        shows = dict()
+        title_matcher = matcher.TitleMatcher()
+        for item in tracker_list:
+            shows[item['id']] = item
+            title_matcher.add(item['id'], item['titles'])
+        
+        self.index = (shows, title_matcher)
+        self._wake()
+    
+    def upsert(self, item):
+        """
+        Adds the show **item** to the list, or replaces the one with
+        the same ID. Its titles are only reindexed if they changed.
+        """
+        (shows, title_matcher) = self.index
+        old_item = shows.get(item['id'])
+        shows[item['id']] = item
+        if not old_item or old_item['titles'] != item['titles']:
+            title_matcher.add(item['id'], item['titles'])
+        self._wake()
+    
+    def remove(self, showid):
+        """Removes the show with **showid** from the list."""
+        (shows, title_matcher) = self.index
+        title_matcher.remove(showid)
+        shows.pop(showid, None)
+        self._wake()
     
     def connect_signal(self, signal, callback):
         try:
@@ -368,135 +622,278 @@ class Tracker(object):
         except KeyError:
             raise Exception("Call to undefined signal.")
 
-    def _get_playing_file(self, players):
+    def _get_playing_files(self, players):
+        if self.detector.available():
+            pids = self.detector.player_pids()
+            self.player_running = bool(pids)
+            return self.detector.playing_files(pids)
+
+        # Fall back to lsof where there's no procfs
         lsof = subprocess.Popen(['lsof', '-n', '-c', ''.join(['/', players, '/']), '-Fn'], stdout=subprocess.PIPE)
         output = lsof.communicate()[0].decode('utf-8')
+        self.player_running = bool(output.strip())
         fileregex = re.compile("n(.*(\.mkv|\.mp4|\.avi))")
         
+        filenames = []
         for line in output.splitlines():
             match = fileregex.match(line)
             if match is not None:
-                return os.path.basename(match.group(1))
+                filename = os.path.basename(match.group(1))
+                if filename not in filenames:
+                    filenames.append(filename)
         
-        return False
+        return filenames
 
     def _analyze(self, filename):
-        aie = AnimeInfoExtractor(filename)
+        aie = extract_info(filename)
         return (aie.getName(), aie.getEpisode())
     
+    def _wake(self):
+        """Makes the tracker thread check the player right away."""
+        with self.condition:
+            self.wakeup = True
+            self.condition.notify()
+    
+    def _wait(self, timeout):
+        """Sleeps for **timeout** seconds, or until someone calls :func:`_wake`."""
+        with self.condition:
+            if not self.wakeup:
+                self.condition.wait(timeout)
+            self.wakeup = False
+    
+    def _count_poll(self):
+        with self.condition:
+            now = time.time()
+            self.polls.append(now)
+            self._prune_polls(now)
+    
+    def _prune_polls(self, now):
+        while self.polls and self.polls[0] < now - 3600:
+            self.polls.popleft()
+    
     def _tracker(self, interval, wait):
-        last_state = None
-        last_time = 0
-        last_updated = False
         wait_s = wait * 60
+        idle_delay = interval
         
         while True:
-            # This runs the tracker and returns the playing show, if any
-            (state, show_tuple) = self._iteration()
-
-            if show_tuple:
-                (show, episode) = show_tuple
+            # This runs the tracker and returns the files being played, if any
+            filenames = self._iteration()
+            delay = interval
+            self._count_poll()
+            
+            try:
+                # Close the sessions of the files that aren't open anymore
+                for filename in self.sessions.keys():
+                    if filename not in filenames:
+                        self._close_session(filename)
                 
-                if not self.last_show_tuple or show['id'] != self.last_show_tuple[0]['id'] or episode != self.last_show_tuple[1]:
-                    # There's a new show detected, so
-                    # let's save the show information and
-                    # the time we detected it first
+                # Only files we didn't see before need to be matched
+                for filename in filenames:
+                    session = self.sessions.get(filename)
+                    if not session:
+                        session = self._open_session(filename)
                     
-                    # But if we're watching a new show, let's make sure turn off
-                    # the Playing flag on that one first
-                    if self.last_show_tuple and self.last_show_tuple[0] != show:
-                        self._emit_signal('playing', self.last_show_tuple[0]['id'], False, 0)
- 
-                    self.last_show_tuple = (show, episode)
-                    self._emit_signal('playing', show['id'], True, episode)
- 
-                    last_time = time.time()
-                    last_updated = False
-                
-                if not last_updated:
-                    # Check if we need to update the show yet
-                    if episode == (show['my_progress'] + 1):
-                        timedif = time.time() - last_time
-                        
-                        if timedif > wait_s:
-                            # Time has passed, let's update
-                            self._emit_signal('update', show['id'], episode)
-                            
-                            last_updated = True
-                        else:
-                            self.msg.info(self.name, 'Will update %s %d in %d seconds' % (show['title'], episode, wait_s-timedif))
-                    else:
-                        # We shouldn't update to this episode!
-                        self.msg.warn(self.name, 'Player is not playing the next episode of %s. Ignoring.' % show['title'])
-                        last_updated = True
-                else:
-                    # The episode was updated already. do nothing
-                    pass
-            elif last_state != state:
-                # React depending on state
-                # 1 : No video is playing anymroe
-                # 2 : There's a new video playing but the regex didn't recognize the format
-                # 3 : There's a new video playing but an associated show wasn't found
-                if state == 1 and self.last_show_tuple and not last_updated:
-                    self.msg.info(self.name, 'Player was closed before update.')
-                elif state == 2:
-                    self.msg.warn(self.name, 'Found video but the file name format couldn\'t be recognized.')
-                elif state == 3:
-                    self.msg.warn(self.name, 'Found player but show not in list.')
-                
-                # Clear any show previously playing
-                if self.last_show_tuple:
-                    self._emit_signal('playing', self.last_show_tuple[0]['id'], False, 0)
-                    last_updated = False
-                    last_time = 0
-                    self.last_show_tuple = None
+                    remaining = self._check_session(session, wait_s)
+                    if remaining is not None:
+                        # Check again right when it's time to update
+                        delay = max(self.min_interval, min(delay, remaining))
+            except utils.wmalError, e:
+                # Whoever got the signal couldn't handle it; don't let
+                # that stop the tracker
+                self.msg.warn(self.name, 'Error handling the playing show: %s' % e)
             
-            last_state = state
+            if self.player_running:
+                idle_delay = interval
+            else:
+                # There's nothing to track, so check less and less often
+                delay = idle_delay
+                idle_delay = min(idle_delay * 2, max(interval, self.max_interval))
             
-            # Wait for the interval before running check again
-            time.sleep(interval)
+            # Wait before running check again
+            self._wait(delay)
     
     def _iteration(self):
         if not self.active:
             # Don't do anything if the Tracker is disabled
-            return (1, None)
+            self.player_running = False
+            return []
         
-        filename = self._get_playing_file(self.process_name)
+        return self._get_playing_files(self.process_name)
+    
+    def _open_session(self, filename):
+        """Starts following a file that just started playing."""
+        (state, show_tuple) = self._match(filename)
+        session = {'show_tuple': show_tuple,
+                   'started': time.time(),
+                   'updated': True}
+        self.sessions[filename] = session
         
-        if filename:
-            if filename == self.last_filename:
-                # It's the exact same filename, there's no need to do the processing again
-                return (4, self.last_show_tuple)
-            
-            self.last_filename = filename
-
-            # Do a regex to the filename to get
-            # the show title and episode number
-            (show_title, show_ep) = self._analyze(filename)
-            if not show_title:
-                return (2, None) # Format not recognized
+        if state == 2:
+            self.msg.warn(self.name, 'Found video but the file name format couldn\'t be recognized.')
+        elif state == 3:
+            self.msg.warn(self.name, 'Found player but show not in list.')
+        else:
+            (show, episode) = show_tuple
+            self._emit_signal('playing', show['id'], True, episode)
             
-            # Use difflib to see if the show title is similar to
-            # one we have in the list
-            highest_ratio = (None, 0)
-            matcher = difflib.SequenceMatcher()
-            matcher.set_seq1(show_title.lower())
+            if episode == (show['my_progress'] + 1):
+                session['updated'] = False
+            else:
+                # We shouldn't update to this episode!
+                self.msg.warn(self.name, 'Player is not playing the next episode of %s. Ignoring.' % show['title'])
+        
+        return session
+    
+    def _check_session(self, session, wait_s):
+        """
+        Updates the show of **session** if it has been playing long enough.
+        Returns the seconds left until that happens, or None if it won't.
+        """
+        if session['updated']:
+            return None
+        
+        (show, episode) = session['show_tuple']
+        timedif = time.time() - session['started']
+        if timedif > wait_s:
+            # Time has passed, let's update, unless another player
+            # playing the same episode did it already
+            already_updated = self._already_updated(show['id'], episode)
+            session['updated'] = True
+            if not already_updated:
+                self._emit_signal('update', show['id'], episode)
+            return None
+        
+        self.msg.info(self.name, 'Will update %s %d in %d seconds' % (show['title'], episode, wait_s-timedif))
+        return wait_s - timedif
+    
+    def _already_updated(self, showid, episode):
+        """Returns True if the show is already at **episode**, or about to be."""
+        (shows, title_matcher) = self.index
+        current = shows.get(showid)
+        if current and current['my_progress'] >= episode:
+            return True
+        
+        for session in self.sessions.itervalues():
+            other = session['show_tuple']
+            if session['updated'] and other and other[0]['id'] == showid and other[1] == episode:
+                return True
+        return False
+    
+    def _close_session(self, filename):
+        """Stops following a file that isn't being played anymore."""
+        session = self.sessions.pop(filename)
+        if not session['show_tuple']:
+            return
+        
+        show = session['show_tuple'][0]
+        if not session['updated']:
+            self.msg.info(self.name, 'Player was closed before update.')
+        
+        # Another player might still be playing the same show
+        for other in self.sessions.itervalues():
+            if other['show_tuple'] and other['show_tuple'][0]['id'] == show['id']:
+                return
+        self._emit_signal('playing', show['id'], False, 0)
+    
+    def _match(self, filename):
+        # Do a regex to the filename to get
+        # the show title and episode number
+        (show_title, show_ep) = self._analyze(filename)
+        if not show_title:
+            return (2, None) # Format not recognized
+        
+        # See if the show title is similar to one we have in the
+        # list, making sure to search through all the aliases
+        (shows, title_matcher) = self.index
+        (showid, ratio) = title_matcher.match(show_title)
+        
+        # The show may have been removed since the match
+        show = shows.get(showid) if showid is not None else None
+        if show:
+            return (0, (show, show_ep))
+        else:
+            return (3, None) # Show not in list
+    
+    def _ipc_tracker(self, interval):
+        idle_delay = interval
+        
+        while True:
+            self._count_poll()
+            try:
+                self.ipc.connect()
+            except socket.error:
+                # The player isn't running, try again later
+                self._wait(idle_delay)
+                idle_delay = min(idle_delay * 2, max(interval, self.max_interval))
+                continue
             
-            # Compare to every show in our list to see which one
-            # has the most similar name
-            for item in self.list:
-                # Make sure to search through all the aliases
-                for title in item['titles']:
-                    matcher.set_seq2(title.lower())
-                    ratio = matcher.ratio()
-                    if ratio > highest_ratio[1]:
-                        highest_ratio = (item, ratio)
+            self.msg.debug(self.name, 'Connected to player.')
+            idle_delay = interval
+            try:
+                for event in self.ipc.events():
+                    try:
+                        self._ipc_event(event)
+                    except utils.wmalError, e:
+                        self.msg.warn(self.name, 'Error handling the playing show: %s' % e)
+            except socket.error, e:
+                self.msg.warn(self.name, 'Lost connection to player: %s' % e)
             
-            playing_show = highest_ratio[0]
-            if highest_ratio[1] > 0.7:
-                return (0, (playing_show, show_ep))
-            else:
-                return (3, None) # Show not in list
+            self.ipc.close()
+            self._ipc_stopped()
+    
+    def _ipc_event(self, event):
+        if not self.active:
+            # Don't do anything if the Tracker is disabled
+            self._ipc_stopped()
+            return
+        
+        if event['event'] == 'property-change':
+            if event.get('name') == 'path':
+                if event.get('data'):
+                    self._ipc_file(os.path.basename(event['data']))
+                else:
+                    self._ipc_stopped()
+            elif event.get('name') == 'percent-pos' and event.get('data') is not None:
+                self._ipc_position(event['data'])
+        elif event['event'] in ('end-file', 'idle'):
+            self._ipc_stopped()
+    
+    def _ipc_file(self, filename):
+        (state, show_tuple) = self._match(filename)
+        
+        # Turn off the Playing flag of the show we were watching before
+        if self.last_show_tuple and (not show_tuple or self.last_show_tuple[0] != show_tuple[0]):
+            self._emit_signal('playing', self.last_show_tuple[0]['id'], False, 0)
+        
+        self.last_show_tuple = show_tuple
+        self.last_updated = False
+        
+        if state == 2:
+            self.msg.warn(self.name, 'Found video but the file name format couldn\'t be recognized.')
+        elif state == 3:
+            self.msg.warn(self.name, 'Found player but show not in list.')
         else:
-            self.last_filename = None
-            return (1, None) # Not playing
+            (show, episode) = show_tuple
+            self._emit_signal('playing', show['id'], True, episode)
+            
+            if episode != (show['my_progress'] + 1):
+                # We shouldn't update to this episode!
+                self.msg.warn(self.name, 'Player is not playing the next episode of %s. Ignoring.' % show['title'])
+                self.last_updated = True
+    
+    def _ipc_position(self, percent):
+        if not self.last_show_tuple or self.last_updated:
+            return
+        
+        if percent >= self.update_percent:
+            (show, episode) = self.last_show_tuple
+            self.last_updated = True
+            self._emit_signal('update', show['id'], episode)
+    
+    def _ipc_stopped(self):
+        if self.last_show_tuple:
+            if not self.last_updated:
+                self.msg.info(self.name, 'Playback stopped before update.')
+            self._emit_signal('playing', self.last_show_tuple[0]['id'], False, 0)
+            self.last_show_tuple = None
+        self.last_updated = False
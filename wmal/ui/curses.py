@@ -189,6 +189,7 @@ class wMAL_urwid(object):
         self.engine.connect_signal('show_added', self.changed_list)
         self.engine.connect_signal('show_deleted', self.changed_list)
         self.engine.connect_signal('show_synced', self.changed_show)
+        self.engine.connect_signal('show_changed', self.changed_show)
 
         # Engine start and list rebuildi
         self.status("Building lists...")
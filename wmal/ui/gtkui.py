@@ -339,6 +339,7 @@ class wmal_gtk(object):
         self.engine.connect_signal('playing', self.playing_show)
         self.engine.connect_signal('show_added', self.changed_show_status)
         self.engine.connect_signal('show_deleted', self.changed_show_status)
+        self.engine.connect_signal('show_changed', self.changed_show)
         
         self.selected_show = 0
         
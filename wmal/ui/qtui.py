@@ -1605,6 +1605,7 @@ class Engine_Worker(QtCore.QThread):
         self.engine.connect_signal('show_added', self._changed_list)
         self.engine.connect_signal('show_deleted', self._changed_list)
         self.engine.connect_signal('show_synced', self._changed_show)
+        self.engine.connect_signal('show_changed', self._changed_show)
         self.engine.connect_signal('queue_changed', self._changed_queue)
 
         self.function_list = {
@@ -17,6 +17,8 @@
 import os, re, shutil, copy
 import subprocess
 import json
+import threading
+from collections import OrderedDict
 
 VERSION = '0.3'
 
@@ -133,6 +135,54 @@ def show():
         'neweps':       False,
     }
 
+class LRUCache(object):
+    """
+    Dictionary-like cache that only keeps the **size** most recently
+    used items, discarding the least recently used one when it's full.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+
+            # Move it back to the most recently used end
+            self.items[key] = value
+            return value
+
+    def __getitem__(self, key):
+        with self.lock:
+            value = self.items.pop(key)
+            self.items[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.items.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
 class wmalError(Exception):
     pass
 
@@ -165,9 +215,12 @@ config_defaults = {
     'player': 'mpv',
     'searchdir': '/home/user/Videos',
     'tracker_enabled': True,
+    'library_watch': False,
     'tracker_update_wait': 5,
     'tracker_interval': 60,
     'tracker_process': 'mplayer|mplayer2|mpv',
+    'tracker_ipc_socket': '',
+    'tracker_update_percent': 80,
     'autoretrieve': 'days',
     'autoretrieve_days': 3,
     'autosend': 'hours',
@@ -175,6 +228,8 @@ config_defaults = {
     'autosend_size': 5,
     'autosend_at_exit': True,
     'debug_disable_lock': True,
+    'storage_engine': 'sqlite',
+    'flush_delay': 5,
     'auto_status_change': True,
     'auto_status_change_if_scored': True,
     'auto_date_change': True,